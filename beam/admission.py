@@ -0,0 +1,90 @@
+import logging
+import time
+
+import tornado.ioloop
+
+from beam.backpressure import FlowControl
+
+"""
+Load shedding for a saturated Beam process.
+
+Every room shares one event loop, so once it can't keep up, every game
+slows down together. Admission control turns away new rooms and new
+players while the loop is late or too much data waits to be sent,
+so the games already running keep their latency.
+"""
+
+
+class AdmissionControl:
+    """
+    Samples the event loop lag every interval seconds. Shedding starts once
+    the lag goes over max_lag seconds or unsent bytes (FlowControl.total_buffered)
+    over max_buffered, and stops when both are back under half of that.
+    A limit of None turns its check off.
+    """
+
+    def __init__(self, max_lag=0.5, max_buffered=256 * 1024 * 1024, interval=0.1):
+        self.max_lag = max_lag
+        self.max_buffered = max_buffered
+        self.interval = interval
+
+        # Worst recent lag, decays slowly so short bursts of work still count
+        self.lag = 0.0
+        self.shedding = False
+        self.expected = None
+        self.sampler = None
+
+        # Counters, for monitoring
+        self.rejected_rooms = 0
+        self.rejected_players = 0
+
+    def start(self):
+        if not self.sampler and self.max_lag is not None:
+            self._schedule()
+
+    def stop(self):
+        if self.sampler:
+            tornado.ioloop.IOLoop.current().remove_timeout(self.sampler)
+            self.sampler = None
+
+    def _schedule(self):
+        self.expected = time.monotonic() + self.interval
+        self.sampler = tornado.ioloop.IOLoop.current().call_later(self.interval, self._sample)
+
+    def _sample(self):
+        lag = max(0.0, time.monotonic() - self.expected)
+        self.lag = lag if lag > self.lag else (self.lag + lag) / 2
+        self._schedule()
+
+    def _over(self, fraction):
+        return (self.max_lag is not None and self.lag > self.max_lag * fraction) or \
+            (self.max_buffered is not None and FlowControl.total_buffered > self.max_buffered * fraction)
+
+    def overloaded(self) -> bool:
+        # The sampler starts with the first check, nothing is late before that
+        self.start()
+        if self.shedding:
+            self.shedding = self._over(0.5)
+            if not self.shedding:
+                logging.info("No longer overloaded, accepting new rooms and players")
+        elif self._over(1):
+            self.shedding = True
+            logging.warning(f"Overloaded ({self.lag * 1000:.0f}ms loop lag, "
+                            f"{FlowControl.total_buffered} bytes unsent), turning newcomers away")
+        return self.shedding
+
+    def admit_room(self) -> bool:
+        if self.overloaded():
+            self.rejected_rooms += 1
+            return False
+        return True
+
+    def admit_player(self) -> bool:
+        if self.overloaded():
+            self.rejected_players += 1
+            return False
+        return True
+
+    # Seconds clients are told to wait before trying again
+    def retry_after(self):
+        return max(1, round(self.lag * 4))
@@ -0,0 +1,34 @@
+"""
+Flow control for outgoing messages.
+Keeps one slow client from piling up unsent data in memory.
+"""
+
+# What happens when a connection has more unsent data than allowed:
+# "pause"      - stop writing, queue messages until the client catches up
+# "drop"       - drop relayed messages, still deliver Beam's own messages
+# "disconnect" - close the connection with exceptions.SlowConsumer()
+POLICIES = ("pause", "drop", "disconnect")
+
+
+class FlowControl:
+    """
+    Buffer limits shared by all connections of a Beam instance.
+    Sizes are measured in payload bytes, before compression.
+    """
+
+    # Unsent bytes across every connection in the process
+    total_buffered = 0
+
+    def __init__(self, high_water=1024 * 1024, low_water=None, policy="pause"):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown buffer policy: {policy}")
+
+        self.high_water = high_water
+        # Paused connections resume once they're back under this
+        self.low_water = high_water // 2 if low_water is None else low_water
+        self.policy = policy
+
+        # Counters, for monitoring
+        self.pauses = 0
+        self.dropped = 0
+        self.disconnects = 0
@@ -1,16 +1,17 @@
-import asyncio
+import hmac
+import types
 import tornado.escape
+import tornado.ioloop
 import tornado.template
 import tornado.web
 import tornado.websocket
 
-from beam import messages, ratelimiting, exceptions
+from beam import messages, ratelimiting, exceptions, queues, backpressure, protocol, compression, metrics, codes, timers, journal, handoff, admission, coalescing, spectators, codec, tracing
 from beam.servers import Server, ServerPool
-from beam.players import Player
+from beam.players import Player, recipients
 from beam.exceptions import BASE
 
 import logging
-import json
 import time
 
 BEAM_VERSION = "v0"
@@ -22,10 +23,19 @@ class Beam(tornado.web.Application):
     """
 
     def __init__(self, do_inspect, **kwargs):
-        self.pool = ServerPool()
+        # Only set when running as one of several workers, see beam.workers
+        self.SHARD = kwargs.get("shard", 0)
+        self.SHARDS = kwargs.get("shards", 1)
+
+        # Longer codes make room for more rooms per prefix
+        self.CODE_LENGTH = kwargs.get("code_length", 4)
+
+        self.pool = ServerPool(self.SHARD, self.SHARDS, self.CODE_LENGTH)
         self.html = tornado.template.Loader("./html")
 
-        self.rate_limits = ratelimiting.RoomCreateLimiting()
+        # Rooms nobody is connected to are closed after idle_timeout seconds
+        self.IDLE_TIMEOUT = kwargs.get("idle_timeout", 90)
+        self.reaper = timers.TimerWheel(self.reap)
 
         self.MAX_SERVERS = kwargs.get("max_servers", 3)
 
@@ -33,6 +43,87 @@ class Beam(tornado.web.Application):
         self.PER_N_SECONDS = kwargs.get("per_n_seconds", 1)
         self.BAN_FOR = kwargs.get("ban_for", 200)
 
+        self.MAX_CREATED = kwargs.get("max_created", 10)
+        self.CREATED_PER_N_SECONDS = kwargs.get("created_per_n_seconds", 60)
+
+        # One limiter for every room, see beam.ratelimiting
+        self.rate_limits = ratelimiting.RateLimiter(kwargs.get("rate_limit_entries", 65536))
+        self.rate_limits.scope("join", self.MAX_USERS, self.PER_N_SECONDS, self.BAN_FOR)
+        self.rate_limits.scope("create", self.MAX_CREATED, self.CREATED_PER_N_SECONDS)
+
+        # permessage-deflate, frames under compression_min_size bytes aren't compressed
+        self.compression = None
+        if kwargs.get("compression", True):
+            self.compression = compression.CompressionSettings(
+                level=kwargs.get("compression_level", 6),
+                mem_level=kwargs.get("compression_mem_level", 8),
+                window_bits=kwargs.get("compression_window_bits"),
+                context_takeover=kwargs.get("compression_context_takeover", True),
+                min_size=kwargs.get("compression_min_size", 128)
+            )
+
+        # Rooms are saved to this file to survive restarts, see beam.journal
+        self.journal = None
+        if kwargs.get("journal"):
+            self.journal = journal.Journal(kwargs["journal"], self, kwargs.get("journal_interval", 2.0))
+
+        # Shutting down: no new rooms, and everyone is moved away
+        # after drain_timeout seconds unless a successor takes over first
+        self.draining = False
+        self.DRAIN_TIMEOUT = kwargs.get("drain_timeout", 30)
+        self.drain_timer = None
+        # Called once the rooms are gone, see migrate
+        self.migrated = kwargs.get("migrated")
+
+        # Turns newcomers away when the event loop falls behind, see beam.admission
+        self.admission = admission.AdmissionControl(
+            max_lag=kwargs.get("max_loop_lag", 0.5),
+            max_buffered=kwargs.get("max_total_buffered", 256 * 1024 * 1024)
+        )
+
+        # Enables /admin, see BeamAdmin
+        self.ADMIN_TOKEN = kwargs.get("admin_token")
+
+        # Shares rooms with other Beam nodes, see beam.bus
+        self.bus = kwargs.get("bus")
+        if self.bus:
+            self.bus.attach(self)
+
+        # Limits for messages kept for disconnected clients
+        self.QUEUE_MAX_MESSAGES = kwargs.get("queue_max_messages", 1000)
+        self.QUEUE_MAX_BYTES = kwargs.get("queue_max_bytes", 512 * 1024)
+        self.QUEUE_TTL = kwargs.get("queue_ttl", 120)
+        self.QUEUE_POLICY = kwargs.get("queue_policy", "oldest")
+        if self.QUEUE_POLICY not in queues.POLICIES:
+            raise ValueError(f"Unknown queue policy: {self.QUEUE_POLICY}")
+
+        # Messages every room keeps for clients resuming their connection
+        self.HISTORY_SIZE = kwargs.get("history_size", 256)
+
+        # Read-only viewers a single room can have, see beam.spectators
+        self.MAX_SPECTATORS = kwargs.get("max_spectators", 50000)
+
+        # Longest time rooms may hold messages back to send them together,
+        # rooms ask for it with coalesce_ms, see beam.coalescing
+        self.MAX_COALESCE_MS = kwargs.get("max_coalesce_ms", 50)
+        self.COALESCE_BYTES = kwargs.get("coalesce_bytes", 16 * 1024)
+
+        # Events from the hot paths, see beam.tracing. Logged at DEBUG,
+        # written to trace_file, and kept for /inspect/<code> of watched rooms.
+        # trace_sampling is {event name: fraction of them kept}
+        sinks = [tracing.LogSink()]
+        if kwargs.get("trace_file"):
+            sinks.append(tracing.FileSink(kwargs["trace_file"]))
+        if do_inspect:
+            sinks.append(tracing.RingSink(kwargs.get("trace_buffer", 1000)))
+        tracing.TRACER.configure(sinks, kwargs.get("trace_sampling"))
+
+        # How much unsent data a single connection may pile up
+        self.flow = backpressure.FlowControl(
+            high_water=kwargs.get("max_buffer", 1024 * 1024),
+            policy=kwargs.get("buffer_policy", "pause")
+        )
+
         handlers = [
             ("/ws/(.*)", BeamWebsocket),
             ("/beam/(.*)",   BeamCommands)
@@ -43,17 +134,105 @@ class Beam(tornado.web.Application):
                 ("/inspect(.*)", BeamInspector)
             )
 
+        # A drain would only reach the worker the request lands on,
+        # workers stop with the acceptor instead, see beam.workers
+        if self.ADMIN_TOKEN and self.SHARDS > 1:
+            logging.warning("/admin is disabled when running several workers")
+        elif self.ADMIN_TOKEN:
+            handlers.append(
+                ("/admin/(.*)", BeamAdmin)
+            )
+
+        if kwargs.get("metrics", False):
+            handlers.append(
+                ("/metrics", BeamMetrics)
+            )
+
         super().__init__(handlers)
 
+    # Keyword arguments for every new Player and Server
+    def client_options(self):
+        return {
+            "queue": queues.MessageQueue(
+                max_messages=self.QUEUE_MAX_MESSAGES,
+                max_bytes=self.QUEUE_MAX_BYTES,
+                ttl=self.QUEUE_TTL,
+                policy=self.QUEUE_POLICY
+            ),
+            "flow": self.flow
+        }
+
+    # Keyword arguments for every new Server, its players share its history
+    # and its coalescer, when messages are held back for coalesce_ms
+    def room_options(self, coalesce_ms=0, coalesce_bytes=None):
+        options = dict(self.client_options(), history=queues.History(self.HISTORY_SIZE))
+        coalesce_ms = min(coalesce_ms, self.MAX_COALESCE_MS)
+        if coalesce_ms > 0:
+            options["coalescer"] = coalescing.Coalescer(
+                coalesce_ms / 1000, min(coalesce_bytes or self.COALESCE_BYTES, self.COALESCE_BYTES))
+        return options
+
+    def drain(self):
+        if self.draining:
+            return
+        logging.info(f"Draining, moving everyone away in {self.DRAIN_TIMEOUT} seconds")
+        self.draining = True
+        if self.journal:
+            self.journal.write()
+        self.drain_timer = tornado.ioloop.IOLoop.current().call_later(self.DRAIN_TIMEOUT, self.migrate)
+
+    # Tells every client to reconnect, see beam.handoff
+    def migrate(self):
+        if self.drain_timer:
+            tornado.ioloop.IOLoop.current().remove_timeout(self.drain_timer)
+            self.drain_timer = None
+        if self.journal:
+            # Saved with every room before they're let go, the next
+            # process restores them from it
+            self.journal.stop()
+            self.journal = None
+        handoff.migrate(self)
+        if self.migrated:
+            self.migrated()
+        else:
+            # Nothing stops the process, it goes on with new rooms
+            self.draining = False
+
+    # Whether token is the admin_token, always False without one
+    def is_admin(self, token) -> bool:
+        if not self.ADMIN_TOKEN or token is None:
+            return False
+        return hmac.compare_digest(token.encode(), self.ADMIN_TOKEN.encode())
+
+    # Connections of a deleted room still close after it's gone
+    def is_open(self, server):
+        return self.pool.get_server_safe(server.code) is server
+
+    # Rooms have to be saved again after changing, see beam.journal
+    def changed(self, server):
+        if self.journal and self.is_open(server):
+            self.journal.touch(server)
+
     def delete_server(self, server):
+        self.reaper.disarm(server)
+        if self.journal:
+            self.journal.forget(server)
         self.rate_limits.ip_deown(server.owner_ip)
         server.close_server()
         self.pool.free(server.code)
+        if self.bus:
+            self.bus.release(server.code)
+        tracing.TRACER.unwatch(server.code)
         logging.info(f"Closed server: {server.code}")
 
-    async def delete_on_inactive(self, server):
-        logging.info(f"Waiting 90 seconds to close: {server.code}")
-        await asyncio.sleep(90)
+    def close_when_idle(self, server):
+        if not self.is_open(server):
+            return
+        logging.info(f"Waiting {self.IDLE_TIMEOUT} seconds to close: {server.code}")
+        self.reaper.arm(server, self.IDLE_TIMEOUT)
+
+    def reap(self, server):
+        metrics.REAPS.inc()
         self.delete_server(server)
 
 
@@ -74,8 +253,7 @@ class BeamInspector(tornado.web.RequestHandler):
         self.set_header('Access-Control-Allow-Methods', 'POST, GET, OPTIONS')
 
     def get(self, cmd):
-        logging.debug("Handling request BeamInspector/" +
-                      self.request.path)
+        logging.debug("Handling request BeamInspector/%s", self.request.path)
 
         if not cmd.startswith("/"):
             cmd = "/" + cmd
@@ -89,12 +267,67 @@ class BeamInspector(tornado.web.RequestHandler):
         else:
             serv = self.application.pool.get_server_safe(cmd[0])
             if serv:
-                pass  # TODO
+                # Player names and events (which have addresses in them)
+                # are only for the admin_token holder, as is recording them
+                admin = self.application.is_admin(self.get_argument("token", None))
+                watch = self.get_argument("trace", None)
+                if watch is not None and not admin:
+                    self.set_status(401)
+                    return
+
+                # ?trace=1 records every event of the room until ?trace=0
+                if watch == "1":
+                    tracing.TRACER.watch(serv.code)
+                elif watch == "0":
+                    tracing.TRACER.unwatch(serv.code)
+
+                ring = tracing.TRACER.sink(tracing.RingSink)
+                room = {
+                    "code": serv.code,
+                    "limit": serv.limit,
+                    "lock": serv.lock,
+                    "p2pmode": serv.p2pmode,
+                    "active_connections": serv.active_connections,
+                    "spectators": len(serv.spectators or ()),
+                    "traced": serv.code in tracing.TRACER.watched
+                }
+                if admin:
+                    room["players"] = [p.name for p in serv.players.list()]
+                    room["events"] = ring.room(serv.code) if ring else []
+                self.write(room)
             else:
                 self.set_status(404)
                 self.write("Not found")
 
 
+class BeamMetrics(tornado.web.RequestHandler):
+    """
+    Optional Prometheus endpoint, see beam.metrics.
+    """
+
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.write(metrics.expose(self.application))
+
+
+class BeamAdmin(tornado.web.RequestHandler):
+    """
+    Operations on the Beam instance itself,
+    only enabled with the admin_token option.
+    """
+
+    def post(self, cmd):
+        if not self.application.is_admin(self.get_argument("token", None)):
+            self.set_status(401)
+            return
+
+        if cmd == "drain":
+            self.application.drain()
+            self.set_status(202)
+        else:
+            self.set_status(404)
+
+
 class BeamCommands(tornado.web.RequestHandler):
     """
     Object for the /beam endpoint.
@@ -102,7 +335,7 @@ class BeamCommands(tornado.web.RequestHandler):
     """
 
     def prepare(self):
-        logging.debug("Handling request BeamCommands/" + self.path_args[0])
+        logging.debug("Handling request BeamCommands/%s", self.path_args[0])
         if not self.path_args[0].startswith(BEAM_VERSION + "/"):
             self.set_status(400)
             self.write({
@@ -113,6 +346,10 @@ class BeamCommands(tornado.web.RequestHandler):
         self.set_header("Access-Control-Allow-Origin", "*")
         self.set_header("Access-Control-Allow-Headers", "x-requested-with")
         self.set_header('Access-Control-Allow-Methods', 'POST, DELETE')
+        if self.application.SHARDS > 1:
+            # The next request may be for a room of another worker,
+            # it needs a new connection to be routed there
+            self.set_header("Connection", "close")
 
     def post(self, cmd):
         if self._status_code == 400:
@@ -122,6 +359,24 @@ class BeamCommands(tornado.web.RequestHandler):
                 self.write({
                     "error": "you have reached the limit of rooms for your IP address. please remove other servers first"
                 })
+            elif self.application.draining:
+                self.set_status(503)
+                self.set_header("Retry-After", "5")
+                self.write({
+                    "error": "this server is restarting, try again in a few seconds"
+                })
+            elif not self.application.admission.admit_room():
+                self.set_status(503)
+                self.set_header("Retry-After", str(self.application.admission.retry_after()))
+                self.write({
+                    "error": "this server is overloaded, try again in a few seconds"
+                })
+            elif not self.application.rate_limits.allow(self.request.remote_ip, "create"):
+                tracing.trace("rate_limited", ip=self.request.remote_ip, scope="create")
+                self.set_status(429)
+                self.write({
+                    "error": "you are creating rooms too quickly"
+                })
             else:
                 limit = int(self.get_argument("limit", -1))
                 if limit < 0:
@@ -129,16 +384,31 @@ class BeamCommands(tornado.web.RequestHandler):
 
                 prefix = self.get_argument("prefix", "")
 
-                server = self.application.pool.create_server(limit, prefix)
+                # Opt-in, see beam.coalescing
+                coalesce_ms = float(self.get_argument("coalesce_ms", 0))
+                coalesce_bytes = int(self.get_argument("coalesce_bytes", 0))
+
+                try:
+                    server = self.application.pool.create_server(
+                        limit, prefix, **self.application.room_options(coalesce_ms, coalesce_bytes))
+                except codes.PoolExhausted:
+                    self.set_status(503)
+                    self.write({
+                        "error": "there are no free room codes left, try again later"
+                    })
+                    return
                 game_code = server.code
-                token = server.token
+                token = server.token_text
                 server.owner_ip = self.request.remote_ip
                 logging.info(f"Created new Server: {game_code}")
                 self.application.rate_limits.ip_own(server.owner_ip)
-                server.close_task = asyncio.create_task(self.application.delete_on_inactive(server))
+                if self.application.bus:
+                    self.application.bus.claim(game_code)
+                self.application.close_when_idle(server)
+                self.application.changed(server)
                 self.set_status(201)
                 self.write({
-                    "code": game_code[-4:],
+                    "code": game_code[-self.application.CODE_LENGTH:],
                     "token": token
                 })
         else:
@@ -148,14 +418,26 @@ class BeamCommands(tornado.web.RequestHandler):
         if self._status_code == 400:
             return
         if cmd.endswith("server"):
-            server = self.application.pool.get_server_safe(
-                self.get_argument("code"))
+            if self.application.SHARDS > 1 and self.get_query_argument("code", None) is None:
+                # Workers are picked by the query string, see beam.workers
+                self.set_status(400)
+                self.write({
+                    "error": "code has to be in the query string"
+                })
+                return
+            code = self.get_argument("code")
+            server = self.application.pool.get_server_safe(code)
+            bus = self.application.bus
             if server:
-                if server.token == self.get_argument("token"):
+                if server.token_matches(self.get_argument("token")):
                     self.application.delete_server(server)
                     self.set_status(200)
                 else:
                     self.set_status(401)
+            elif bus and bus.home_of(code):
+                # The room lives on another node, which checks the token
+                bus.forward_delete(code, self.get_argument("token"))
+                self.set_status(202)
             else:
                 self.set_status(404)
         else:
@@ -170,42 +452,84 @@ class BeamWebsocket(tornado.websocket.WebSocketHandler):
 
     def __init__(self, application, request, **kwargs) -> None:
         super().__init__(application, request, **kwargs)
+        self._init_state()
+
+    def _init_state(self):
         self.code = None
         self.player_name = None
         self.token = None
+        self.version = 0
+        self.protocol = 0
+        self.resume_from = None
+        self.spectating = False
 
         self.server = None
         self.player = None
+        # Where shared frames are written when spectating
+        self.frames = None
+
+        # (node, conn_id) when the room lives on another node, see beam.bus
+        self.relay = None
 
     def parse_args(self):
         self.code = self.get_argument("code")
         self.player_name = self.get_argument("name", None)
         self.token = self.get_argument("token", None)
+        try:
+            self.protocol = int(self.get_argument("protocol", 0))
+        except ValueError:
+            self.protocol = 0
+        try:
+            self.resume_from = int(self.get_argument("resume_from", None))
+        except (TypeError, ValueError):
+            self.resume_from = None
+        self.spectating = self.get_argument("spectate", "0") == "1"
 
     def check_origin(self, origin):
         # VERY UNSAFE. This should get a tweak as soon as possible!!!
         return True
 
     def get_compression_options(self):
-        # Non-None enables compression with default options
-        return {}
+        # None disables compression, spectators share uncompressed frames
+        if self.application.compression and self.get_argument("spectate", "0") != "1":
+            return self.application.compression.options()
+        return None
+
+    def get_websocket_protocol(self):
+        websocket_protocol = super().get_websocket_protocol()
+        if websocket_protocol and self.get_compression_options() is not None:
+            return compression.DeflateProtocol(
+                self, False, websocket_protocol.params, self.application.compression)
+        return websocket_protocol
 
     def open(self, client):
-        logging.debug("Handling request BeamWebsocket/" +
-                      self.path_args[0])
-        if not self.path_args[0] == BEAM_VERSION:
+        if not self.path_args[0] in protocol.VERSIONS:
             self.close(code=exceptions.BreakingApiChange())
             return
+        self.version = protocol.VERSIONS.index(self.path_args[0])
 
         self.parse_args()
+        if tracing.TRACER.active:
+            tracing.trace("connect", self.code, name=self.player_name, version=self.version,
+                          owner=bool(self.token and not self.player_name), spectating=self.spectating)
 
         # Check for errors in the connection and kick the client if necessary
         server = self.application.pool.get_server_safe(self.code)
         if not server:
+            bus = self.application.bus
+            if bus and bus.home_of(self.code):
+                # The room lives on another node, pass everything there
+                bus.relay(self, bus.home_of(self.code))
+                return
+
             self.close(code=exceptions.ServerCodeDoesntExist())
             return
 
         self.server = server
+        if self.spectating:
+            self._spectate()
+            return
+
         player = self.server.get_player_safe(self.player_name)
 
         registering = self.player_name and not self.token
@@ -229,75 +553,115 @@ class BeamWebsocket(tornado.websocket.WebSocketHandler):
                 self.close(code=exceptions.NamePropertyIsEmpty())
                 return
 
+            # Games in progress come first, only newcomers are turned away
+            elif not self.application.admission.admit_player():
+                self.close(code=exceptions.Overloaded())
+                return
+
             else:
-                # Check for spam and ban if necessary
-                request_time = time.time()
-                ratelimit = self.server.rate_limit.get_ratelimit_data(
-                    self.request.remote_ip)
-
-                if request_time > ratelimit.banned_until:
-                    ratelimit.banned_until = 0
-                    logging.debug("Lift ban")
-                else:
+                # Check for spam, going over the limit bans the IP
+                if not self.application.rate_limits.allow(self.request.remote_ip, "join"):
+                    tracing.trace("rate_limited", self.code, ip=self.request.remote_ip)
                     self.close(code=exceptions.BannedByRateLimit())
                     return
 
-                if request_time - ratelimit.striking_test < self.application.PER_N_SECONDS:
-                    ratelimit.strike += 1
-                    logging.debug("Award strike")
-                    if ratelimit.strike >= self.application.MAX_USERS:
-                        ratelimit.banned_until = request_time + self.application.BAN_FOR
-                        logging.debug("Issue ban for a spammer")
-                        self.close(code=exceptions.BannedByRateLimit())
-                        return
-                else:
-                    ratelimit.strike = 0
-                    ratelimit.striking_test = request_time
-                    logging.debug("Reset strikes")
-
                 # Add player
-                p = Player(self.player_name, self)
+                p = Player(self.player_name, self, history=self.server.history,
+                           coalescer=self.server.coalescer, **self.application.client_options())
                 self.player = p
                 self.server.add_user(p)
                 p.write_message(
-                    messages.Token(p.token)
+                    messages.Token(p.token_text)
                 )
+                if self.server.state:
+                    p.write_message(messages.State(dict(self.server.state)))
 
         elif logging_in:
             if not player:
                 self.close(code=exceptions.NameDoesntExist())
                 return
 
-            elif player.token != self.token:
+            elif not player.token_matches(self.token):
                 self.close(code=exceptions.TokenCodeMismatch())
                 return
 
             # The player name exists and the code is correct
-            elif player.token == self.token:
+            else:
                 self.player = player
-                self.player.assign(self)
+                self.player.assign(self, self.resume_from)
+                if self.server.state:
+                    self.player.write_message(messages.State(dict(self.server.state)))
                 self.server.write_message(
                     messages.UserConnected(self.player)
                 )
 
         elif owner_connecting:
-            if self.server.token != self.token:
+            if not self.server.token_matches(self.token):
                 self.close(code=exceptions.AdminTokenCodeMismatch())
                 return
             else:
                 self.player = self.server
-                self.player.assign(self)
+                self.player.assign(self, self.resume_from)
                 if self.server.players.count() > 0:
                     self.server.write_message(
                         messages.UsersList(self.server.players.list())
                     )
         
         self.server.active_connections += 1
-        if self.server.close_task:
-            self.server.close_task.cancel()
+        self.application.reaper.disarm(self.server)
+        self.application.changed(self.server)
+
+    # Spectators only watch, see beam.spectators
+    def _spectate(self):
+        if not self.application.admission.admit_player():
+            self.close(code=exceptions.Overloaded())
+            return
+
+        if self.server.spectators is None:
+            self.server.spectators = spectators.Audience(self.application.MAX_SPECTATORS)
+        if len(self.server.spectators) >= self.server.spectators.limit:
+            self.close(code=exceptions.RoomLimitReached())
+            return
+
+        if not self.application.rate_limits.allow(self.request.remote_ip, "join"):
+            tracing.trace("rate_limited", self.code, ip=self.request.remote_ip)
+            self.close(code=exceptions.BannedByRateLimit())
+            return
+
+        self.server.spectators.add(self)
+        if self.server.state:
+            payload = protocol.encode(messages.State(self.server.state), self.version)
+            self.write_frame(spectators.frame(payload, self.version), payload)
+
+    def write_frame(self, frame, payload) -> bool:
+        if self.frames is None:
+            self.frames = spectators.SpectatorStream(
+                self.ws_connection.stream, self.application.flow.high_water, self._resync)
+        return self.frames.write(frame)
+
+    # Frames for a spectator that missed some, so it can start over
+    def _resync(self, missed):
+        resync = [messages.Overflow(missed)]
+        if self.server.state:
+            resync.append(messages.State(dict(self.server.state)))
+        return [spectators.frame(protocol.encode(message, self.version), self.version) for message in resync]
+
+    def close(self, code=None, reason=None):
+        if tracing.TRACER.active:
+            tracing.trace("close", self.code, name=self.player_name, code=code)
+        super().close(code, reason)
 
     # We notify the server owner about the disconnection
     def on_connection_close(self):
+        if self.relay:
+            self.application.bus.relay_closed(self)
+            return
+
+        if self.spectating:
+            if self.server and self.server.spectators:
+                self.server.spectators.discard(self)
+            return
+
         if (self.close_code or 0) < BASE:
             if self.server and isinstance(self.player, Player):
                 self.server.write_message(
@@ -306,46 +670,108 @@ class BeamWebsocket(tornado.websocket.WebSocketHandler):
         if self.player and self.server:
             self.server.active_connections -= 1
             if self.server.active_connections == 0:
-                self.server.close_task = asyncio.create_task(self.application.delete_on_inactive(self.server))
+                self.application.close_when_idle(self.server)
+            self.application.changed(self.server)
 
     # Responsible for delivering messages
 
-    def _send_message(self, data):
-        if data["to"] == 1:
-            recipient = self.server
-        elif data["to"] == 2:
-            recipient = self.server.players
+    def _recipients(self, to):
+        if isinstance(to, protocol.PlayerIndex):
+            return [self.server.players.by_index(to)]
+        elif isinstance(to, protocol.Group):
+            return self.server.players.group(to)
+        elif isinstance(to, dict):
+            return self.server.players.group(str(to.get("group")))
+        elif isinstance(to, list):
+            # Listed more than once, or through several groups, still sent once
+            return list(dict.fromkeys(r for item in to for r in self._recipients(item)))
+        elif to == 1:
+            return [self.server]
+        elif to == 2:
+            return self.server.players.list() + [self.server]
         else:
-            recipient = self.server.get_player_safe(data["to"])
+            return [self.server.get_player_safe(to)]
 
-        self.player.sends_message(
-            recipient,
-            messages.Message(self.player, data["content"])
-        )
-        if data["to"] == 2:
-            self.player.sends_message(
-                self.server,
-                messages.Message(self.player, data["content"])
-            )
+    # Players of a group command, by name or index
+    def _members(self, data):
+        for player in data.get("players") or ():
+            if isinstance(player, protocol.PlayerIndex):
+                player = self.server.players.by_index(player)
+            else:
+                player = self.server.get_player_safe(player)
+            if player:
+                yield player
+
+    def _send_message(self, data):
+        # A broadcast is encoded once and shared by every recipient
+        to = recipients(self._recipients(data["to"]))
+        metrics.FANOUT.observe(len(to))
+        encoded = self.player.sends_message(to, messages.Message(self.player, data["content"]))
+        if self._to_spectators(data["to"]):
+            self.server.spectators.broadcast(encoded)
+
+    # Spectators get what the owner sends to everyone
+    def _to_spectators(self, to):
+        return to == 2 and isinstance(self.player, Server) and self.server.spectators
+
+    def _send_batch(self, parts):
+        # Every recipient gets all of its parts in one frame if it can
+        deliveries = {}
+        watched = []
+        for part in parts:
+            message = messages.Message(self.player, part["content"])
+            to = recipients(self._recipients(part["to"]))
+            metrics.FANOUT.observe(len(to))
+            for recipient in to:
+                deliveries.setdefault(recipient, []).append(message)
+            if self._to_spectators(part["to"]):
+                watched.append(message)
+
+        self.player.sends_batch(deliveries)
+        if watched:
+            self.server.spectators.broadcast(protocol.Encoded(
+                watched[0] if len(watched) == 1 else messages.Batch(watched)))
 
     # Fires when a WS packet is received
     def on_message(self, message):
-        command = ord(message[0])
-        if len(message) > 1:
-            data = json.loads(message[1:])
+        if self.relay:
+            self.application.bus.relay_message(self, message)
+            return
+        if self.spectating:
+            return
+
+        if tracing.TRACER.active:
+            tracing.trace("message", self.code, name=self.player_name, size=len(message))
+        start = time.perf_counter()
+        self._handle_message(message)
+        metrics.MESSAGE_SECONDS.observe(time.perf_counter() - start)
+
+    def _handle_message(self, message):
+        if self.version == 0:
+            command = ord(message[0])
+            if command == 39:
+                data = protocol.decode_relay(message)
+            elif len(message) > 1:
+                data = codec.loads(message[1:])
+        else:
+            command, data = protocol.decode_v1(message)
+
+        counter = metrics.COMMANDS.get(command)
+        if counter:
+            counter.inc()
 
         # Discard packet.
         if command == 32:
             return
 
         # Send a message.
-        if command == 33:
+        # 39 does the same, but the content is passed on without parsing it.
+        if command == 33 or command == 39:
             self._send_message(data)
 
         # Send more messages at once.
         elif command == 34:
-            for part in data:
-                self._send_message(part)
+            self._send_batch(data)
 
         # Lock the instance; ban newcomers.
         if command == 35 and isinstance(self.player, Server):
@@ -362,3 +788,71 @@ class BeamWebsocket(tornado.websocket.WebSocketHandler):
         # Disable p2p mode
         if command == 38 and isinstance(self.player, Server):
             self.server.p2pmode = False
+
+        # Add players to a group.
+        if command == 40 and isinstance(self.player, Server):
+            for player in self._members(data):
+                self.server.players.join_group(str(data["group"]), player)
+
+        # Remove players from a group, or the whole group.
+        if command == 41 and isinstance(self.player, Server):
+            if data.get("players"):
+                for player in self._members(data):
+                    self.server.players.leave_group(str(data["group"]), player)
+            else:
+                self.server.players.delete_group(str(data["group"]))
+
+        # Change the shared state.
+        if command == 42 and isinstance(self.player, Server) and isinstance(data, dict):
+            self.server.set_state(data)
+
+        # Delete keys of the shared state.
+        if command == 43 and isinstance(self.player, Server) and isinstance(data, list):
+            self.server.delete_state(data)
+
+        if (35 <= command <= 38 or 40 <= command <= 43) and isinstance(self.player, Server):
+            self.application.changed(self.server)
+
+
+class RemoteWebsocket(BeamWebsocket):
+    """
+    A client connected to another Beam node, relayed over the bus.
+    Runs the same logic as BeamWebsocket, but writes go through the bus.
+    """
+
+    def __init__(self, application, bus, node, conn_id, version, arguments, remote_ip) -> None:
+        # There's no Tornado connection behind this, so the parent constructor is skipped
+        self.application = application
+        self.request = types.SimpleNamespace(remote_ip=remote_ip)
+        self.path_args = [version]
+        self._init_state()
+
+        self.bus = bus
+        self.node = node
+        self.conn_id = conn_id
+        self.arguments = arguments
+
+        self.closed = False
+        self.close_code = None
+
+    def get_argument(self, name, default=None):
+        return self.arguments.get(name, default)
+
+    def write_message(self, message, binary=False):
+        if self.closed:
+            raise tornado.websocket.WebSocketClosedError()
+        self.bus.deliver(self.node, self.conn_id, message)
+
+    # The frames are built on the other node
+    def write_frame(self, frame, payload) -> bool:
+        if not self.closed:
+            self.bus.deliver(self.node, self.conn_id, payload)
+        return True
+
+    def close(self, code=None, reason=None):
+        if tracing.TRACER.active:
+            tracing.trace("close", self.code, name=self.player_name, code=code)
+        if not self.closed:
+            self.closed = True
+            self.close_code = code
+            self.bus.send(self.node, ["close", self.conn_id, code])
@@ -0,0 +1,377 @@
+import asyncio
+import base64
+import json
+import logging
+import struct
+import sys
+import time
+import uuid
+
+import tornado.websocket
+
+from beam import exceptions
+
+"""
+Message bus connecting several Beam nodes.
+
+A room lives on the node where it was created (its home). When a client
+connects to another node, that node relays the connection over the bus:
+the home node runs the usual BeamWebsocket logic on a RemoteWebsocket and
+everything it writes is sent back to the node holding the real socket.
+
+Items sent to the same node during one event loop iteration travel in one
+batch, and a payload written to many connections of the same node
+(a broadcast) travels only once.
+
+A broker routes the batches and keeps the directory of rooms.
+LocalBroker connects nodes running in the same process,
+UnixBroker connects processes on the same host.
+"""
+
+
+class LatencyStats:
+    """
+    Running count, average and maximum of a latency, in seconds.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, latency):
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+
+    @property
+    def average(self):
+        return self.total / self.count if self.count else 0.0
+
+
+class Bus:
+    """
+    A node's connection to the broker.
+    Subclasses implement _send and deliver incoming frames to receive.
+    """
+
+    def __init__(self, node=None):
+        self.node = node or uuid.uuid4().hex[:8]
+        self.app = None
+
+        # Room code -> node, for every room of every node
+        self.rooms = {}
+
+        # Local sockets relayed to other nodes: conn_id -> BeamWebsocket
+        self.relays = {}
+        self.next_conn_id = 0
+        # Sockets of other nodes handled here: (node, conn_id) -> RemoteWebsocket
+        self.remotes = {}
+
+        # Items waiting for the end of the event loop iteration: node -> items
+        self.pending = {}
+        self.flush_scheduled = False
+
+        self.batches_sent = 0
+        self.items_sent = 0
+        self.to_broker = LatencyStats()
+        self.from_broker = LatencyStats()
+
+    def attach(self, app):
+        self.app = app
+        app.pool.remote = self.rooms
+
+    def _send(self, frame):
+        raise NotImplementedError
+
+    # Directory
+
+    def home_of(self, code):
+        node = self.rooms.get(code)
+        return node if node != self.node else None
+
+    def claim(self, code):
+        self.rooms[code] = self.node
+        self._send({"op": "claim", "code": code})
+
+    def release(self, code):
+        if self.rooms.get(code) == self.node:
+            self.rooms.pop(code)
+        self._send({"op": "release", "code": code})
+
+    # Batching
+
+    def send(self, node, item):
+        self.pending.setdefault(node, []).append(item)
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self.flush)
+
+    def flush(self):
+        self.flush_scheduled = False
+        pending, self.pending = self.pending, {}
+        for node, items in pending.items():
+            self.batches_sent += 1
+            self.items_sent += len(items)
+            self._send({"op": "batch", "to": node, "sent": time.time(), "items": items})
+
+    # Called by RemoteWebsocket.write_message
+    def deliver(self, node, conn_id, payload):
+        items = self.pending.get(node)
+        # Consecutive writes of the same payload (a broadcast) share one item
+        if items and items[-1][0] == "out" and items[-1][2] is payload:
+            items[-1][1].append(conn_id)
+        else:
+            self.send(node, ["out", [conn_id], payload])
+
+    # Relaying local sockets
+
+    def relay(self, handler, home):
+        conn_id = self.next_conn_id
+        self.next_conn_id += 1
+        self.relays[conn_id] = handler
+        handler.relay = (home, conn_id)
+
+        arguments = {
+            name: handler.get_query_argument(name)
+            for name in handler.request.query_arguments
+        }
+        self.send(home, ["open", conn_id, handler.path_args[0], arguments, handler.request.remote_ip])
+
+    def relay_message(self, handler, message):
+        home, conn_id = handler.relay
+        self.send(home, ["in", conn_id, message])
+
+    def relay_closed(self, handler):
+        home, conn_id = handler.relay
+        if self.relays.pop(conn_id, None):
+            self.send(home, ["gone", conn_id, handler.close_code])
+
+    def forward_delete(self, code, token):
+        self.send(self.rooms[code], ["delete", code, token])
+
+    # Incoming frames
+
+    def receive(self, frame):
+        op = frame["op"]
+        if op == "rooms":
+            self.rooms.update(frame["rooms"])
+        elif op == "claim":
+            self.rooms[frame["code"]] = frame["node"]
+        elif op == "release":
+            if self.rooms.get(frame["code"]) == frame["node"]:
+                self.rooms.pop(frame["code"])
+        elif op == "left":
+            self._node_left(frame["node"])
+        elif op == "batch":
+            now = time.time()
+            self.to_broker.add(frame["relayed"] - frame["sent"])
+            self.from_broker.add(now - frame["relayed"])
+            for item in frame["items"]:
+                self._handle(frame["from"], item)
+
+    def _handle(self, node, item):
+        kind = item[0]
+        if kind == "out":
+            _, conn_ids, payload = item
+            for conn_id in conn_ids:
+                handler = self.relays.get(conn_id)
+                if handler:
+                    try:
+                        handler.write_message(payload, binary=handler.version == 1)
+                    except tornado.websocket.WebSocketClosedError:
+                        pass
+
+        elif kind == "close":
+            _, conn_id, code = item
+            handler = self.relays.get(conn_id)
+            if handler:
+                handler.close(code=code)
+
+        elif kind == "open":
+            from beam.beam import RemoteWebsocket
+
+            _, conn_id, version, arguments, remote_ip = item
+            ws = RemoteWebsocket(self.app, self, node, conn_id, version, arguments, remote_ip)
+            self.remotes[(node, conn_id)] = ws
+            ws.open(version)
+
+        elif kind == "in":
+            _, conn_id, message = item
+            ws = self.remotes.get((node, conn_id))
+            if ws and not ws.closed:
+                ws.on_message(message)
+
+        elif kind == "gone":
+            _, conn_id, code = item
+            ws = self.remotes.pop((node, conn_id), None)
+            if ws:
+                ws.closed = True
+                if ws.close_code is None:
+                    ws.close_code = code
+                ws.on_connection_close()
+
+        elif kind == "delete":
+            _, code, token = item
+            server = self.app.pool.get_server_safe(code)
+            if server and server.token_matches(token):
+                self.app.delete_server(server)
+
+    def _node_left(self, node):
+        logging.info(f"Bus node {node} left")
+        for code in [c for c, n in self.rooms.items() if n == node]:
+            self.rooms.pop(code)
+
+        for key in [k for k in self.remotes if k[0] == node]:
+            ws = self.remotes.pop(key)
+            ws.closed = True
+            ws.on_connection_close()
+
+        for conn_id, handler in list(self.relays.items()):
+            if handler.relay[0] == node:
+                handler.close(code=exceptions.ServerClosing())
+
+
+class Broker:
+    """
+    Routes batches between nodes and keeps the directory of rooms.
+    Subclasses call join, leave and handle for their connections.
+    """
+
+    def __init__(self):
+        self.nodes = {}  # node -> function sending a frame to it
+        self.rooms = {}
+
+    def join(self, node, send):
+        self.nodes[node] = send
+        send({"op": "rooms", "rooms": dict(self.rooms)})
+        logging.info(f"Bus node {node} joined")
+
+    def leave(self, node):
+        self.nodes.pop(node, None)
+        for code in [c for c, n in self.rooms.items() if n == node]:
+            self.rooms.pop(code)
+        self._broadcast({"op": "left", "node": node})
+
+    def _broadcast(self, frame):
+        for send in self.nodes.values():
+            send(frame)
+
+    def handle(self, node, frame):
+        op = frame["op"]
+        if op == "claim":
+            self.rooms.setdefault(frame["code"], node)
+            self._broadcast({"op": "claim", "code": frame["code"], "node": self.rooms[frame["code"]]})
+        elif op == "release":
+            if self.rooms.get(frame["code"]) == node:
+                self.rooms.pop(frame["code"])
+                self._broadcast({"op": "release", "code": frame["code"], "node": node})
+        elif op == "batch":
+            send = self.nodes.get(frame["to"])
+            if send:
+                frame["from"] = node
+                frame["relayed"] = time.time()
+                send(frame)
+
+
+class LocalBroker(Broker):
+    """
+    Broker for nodes living in the same process, mostly useful for testing.
+    """
+
+    def connect(self, bus):
+        loop = asyncio.get_running_loop()
+        self.join(bus.node, lambda frame: loop.call_soon(bus.receive, frame))
+
+
+class LocalBus(Bus):
+    def __init__(self, broker: LocalBroker, node=None):
+        super().__init__(node)
+        self.broker = broker
+
+    async def connect(self):
+        self.broker.connect(self)
+
+    def _send(self, frame):
+        asyncio.get_running_loop().call_soon(self.broker.handle, self.node, frame)
+
+
+# Frames on Unix sockets are JSON, prefixed with their length.
+# Binary payloads (protocol v1) are wrapped in {"$b": base64}.
+
+def _json_default(value):
+    return {"$b": base64.b64encode(value).decode()}
+
+
+def _json_object(value):
+    if "$b" in value:
+        return base64.b64decode(value["$b"])
+    return value
+
+
+def _write_frame(writer, frame):
+    data = json.dumps(frame, default=_json_default).encode()
+    writer.write(struct.pack("!I", len(data)) + data)
+
+
+async def _read_frame(reader):
+    size, = struct.unpack("!I", await reader.readexactly(4))
+    return json.loads(await reader.readexactly(size), object_hook=_json_object)
+
+
+class UnixBroker(Broker):
+    """
+    Broker for Beam processes on the same host, listening on a Unix socket.
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+
+    async def serve(self):
+        server = await asyncio.start_unix_server(self._connection, self.path)
+        logging.info(f"Bus broker listening on {self.path}")
+        async with server:
+            await server.serve_forever()
+
+    async def _connection(self, reader, writer):
+        node = None
+        try:
+            hello = await _read_frame(reader)
+            node = hello["node"]
+            self.join(node, lambda frame: _write_frame(writer, frame))
+            while True:
+                self.handle(node, await _read_frame(reader))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if node:
+                self.leave(node)
+            writer.close()
+
+
+class UnixBus(Bus):
+    def __init__(self, path, node=None):
+        super().__init__(node)
+        self.path = path
+        self.writer = None
+
+    async def connect(self):
+        reader, self.writer = await asyncio.open_unix_connection(self.path)
+        _write_frame(self.writer, {"op": "hello", "node": self.node})
+        asyncio.create_task(self._read(reader))
+
+    async def _read(self, reader):
+        try:
+            while True:
+                self.receive(await _read_frame(reader))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logging.error("Lost the connection to the bus broker")
+
+    def _send(self, frame):
+        _write_frame(self.writer, frame)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(UnixBroker(sys.argv[1]).serve())
@@ -0,0 +1,66 @@
+import time
+
+import tornado.ioloop
+
+from beam import metrics
+
+"""
+Holding outgoing messages back for a moment to send them in fewer frames.
+
+Fast rooms send lots of small messages in bursts, every one of them costs
+a WebSocket frame and a write. A room created with coalescing holds the
+messages of its connections for up to a few milliseconds (or until enough
+bytes pile up) and sends everything a connection got meanwhile as one
+batch frame. Only connections that understand batches are held back.
+"""
+
+
+class Coalescer:
+    """
+    Shared by a room and its players. Messages are held for at most
+    delay seconds, or until a connection has max_bytes waiting.
+    """
+
+    def __init__(self, delay: float, max_bytes: int):
+        self.delay = delay
+        self.max_bytes = max_bytes
+
+        # client -> [[(encoded, payload)], bytes]
+        self.pending = {}
+        self.since = None
+        self.timer = None
+
+    def hold(self, client, encoded, payload):
+        held = self.pending.get(client)
+        if held is None:
+            held = self.pending[client] = [[], 0]
+        held[0].append((encoded, payload))
+        held[1] += len(payload)
+
+        if held[1] >= self.max_bytes:
+            self.release(client)
+        elif self.timer is None:
+            self.since = time.perf_counter()
+            self.timer = tornado.ioloop.IOLoop.current().call_later(self.delay, self.flush)
+
+    # Sends what a connection has waiting right away
+    def release(self, client):
+        held = self.take(client)
+        if held:
+            self._send(client, held)
+
+    # What a connection has waiting, without sending it
+    def take(self, client):
+        held = self.pending.pop(client, None)
+        return held[0] if held else []
+
+    def flush(self):
+        self.timer = None
+        metrics.COALESCE_SECONDS.observe(time.perf_counter() - self.since)
+        pending, self.pending = self.pending, {}
+        for client, (held, _) in pending.items():
+            self._send(client, held)
+
+    def _send(self, client, held):
+        metrics.COALESCED.inc(len(held) - 1)
+        client.send_together([encoded for encoded, _ in held], [payload for _, payload in held])
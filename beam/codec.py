@@ -0,0 +1,60 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+"""
+JSON for the message hot path.
+
+Uses orjson when it's installed and the standard library otherwise.
+Encoded JSON is always UTF-8 bytes, the way it goes on the wire, so a
+payload shared by many recipients isn't converted again for each of them.
+Both give the same values once decoded, the bytes themselves may differ
+(orjson leaves out the spaces), see benchmarks/codec.py.
+"""
+
+
+def _default(value):
+    # Players are written as their names, binary data from v1 clients as text
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value).decode("utf-8", "replace")
+    if hasattr(value, "name"):
+        return value.name
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+_json = json.JSONEncoder(default=_default)
+
+
+def std_dumps(value) -> bytes:
+    return _json.encode(value).encode()
+
+
+def std_loads(data):
+    if isinstance(data, memoryview):
+        data = bytes(data)
+    return json.loads(data)
+
+
+if orjson:
+    NAME = "orjson"
+
+    def dumps(value) -> bytes:
+        try:
+            return orjson.dumps(value, default=_default)
+        except orjson.JSONEncodeError:
+            # Integers over 64 bits, non-string keys...
+            return std_dumps(value)
+
+    def loads(data):
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # Same as above, invalid JSON still raises a ValueError
+            return std_loads(data)
+else:
+    NAME = "json"
+    dumps = std_dumps
+    loads = std_loads
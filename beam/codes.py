@@ -0,0 +1,145 @@
+import random
+import string
+
+"""
+Room code allocation.
+
+Every prefix gets its own shuffle of all possible codes, drawn one at a time
+(a Fisher-Yates shuffle done lazily). Only positions that were swapped are
+stored, so a prefix costs memory proportional to the rooms using it,
+and allocating or freeing a code takes constant time however full it is.
+"""
+
+LETTERS = string.ascii_uppercase
+
+# Codes of other nodes are put back and drawn again, at most this many times
+MAX_ATTEMPTS = 64
+
+
+class PoolExhausted(Exception):
+    """
+    Every code for the prefix is in use.
+    """
+
+
+class _Shuffle:
+    __slots__ = ("remaining", "swaps", "in_use")
+
+    def __init__(self, size):
+        self.remaining = size
+        self.swaps = {}
+        self.in_use = 0
+
+    def draw(self, i=None):
+        if i is None:
+            i = random.randrange(self.remaining)
+        last = self.remaining - 1
+        value = self.swaps.get(i, i)
+        # Move the last undrawn value into the hole
+        moved = self.swaps.pop(last, last)
+        if i != last:
+            self.swaps[i] = moved
+        self.remaining -= 1
+        return value
+
+    def put_back(self, value):
+        if value != self.remaining:
+            self.swaps[self.remaining] = value
+        self.remaining += 1
+
+
+class CodeAllocator:
+    def __init__(self, length=4, usable=None):
+        """
+        usable(code) tells if a code may ever be used here,
+        codes it refuses are never drawn again.
+        """
+
+        self.length = length
+        self.size = len(LETTERS) ** length
+        self.usable = usable
+        self.prefixes = {}
+
+    def _code(self, prefix, value):
+        letters = []
+        for _ in range(self.length):
+            value, i = divmod(value, len(LETTERS))
+            letters.append(LETTERS[i])
+        return prefix + "".join(letters)
+
+    def _value(self, code):
+        value = 0
+        for letter in reversed(code[-self.length:]):
+            value = value * len(LETTERS) + LETTERS.index(letter)
+        return value
+
+    def allocate(self, prefix="", taken=()):
+        """
+        A free code starting with prefix.
+        Codes in taken (used elsewhere for now) are skipped.
+        """
+
+        shuffle = self.prefixes.get(prefix)
+        if not shuffle:
+            shuffle = self.prefixes[prefix] = _Shuffle(self.size)
+
+        skipped = []
+        try:
+            while shuffle.remaining and len(skipped) < MAX_ATTEMPTS:
+                value = shuffle.draw()
+                code = self._code(prefix, value)
+                if self.usable and not self.usable(code):
+                    continue
+                if code in taken:
+                    skipped.append(value)
+                    continue
+                shuffle.in_use += 1
+                return code
+        finally:
+            for value in skipped:
+                shuffle.put_back(value)
+
+        if not shuffle.in_use and not shuffle.remaining:
+            # Nothing usable at all, don't keep the state around
+            self.prefixes.pop(prefix)
+        raise PoolExhausted(f"No room codes left for prefix {prefix!r}")
+
+    def reserve(self, codes):
+        """
+        Marks codes as used, for rooms restored from beam.journal.
+        Call it once with every code, it takes time proportional
+        to the codes already in use.
+        """
+
+        values = {}
+        for code in codes:
+            values.setdefault(code[:-self.length], []).append(self._value(code))
+
+        for prefix, wanted in values.items():
+            shuffle = self.prefixes.get(prefix)
+            if not shuffle:
+                shuffle = self.prefixes[prefix] = _Shuffle(self.size)
+            # Positions of the values that were moved
+            where = {value: i for i, value in shuffle.swaps.items()}
+
+            for value in wanted:
+                i = where.pop(value, value)
+                if i >= shuffle.remaining or shuffle.swaps.get(i, i) != value:
+                    continue  # Already in use
+                last = shuffle.remaining - 1
+                moved = shuffle.swaps.get(last, last)
+                shuffle.draw(i)
+                if i != last:
+                    where[moved] = i
+                shuffle.in_use += 1
+
+    def free(self, code):
+        prefix = code[:-self.length]
+        shuffle = self.prefixes.get(prefix)
+        if not shuffle:
+            return
+        shuffle.put_back(self._value(code))
+        shuffle.in_use -= 1
+        if not shuffle.in_use:
+            # Every code is available again, start over with a fresh shuffle
+            self.prefixes.pop(prefix)
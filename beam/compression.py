@@ -0,0 +1,102 @@
+import time
+
+import tornado.websocket
+
+"""
+permessage-deflate settings for the WebSocket endpoint.
+Small frames are sent uncompressed, the deflate context setup isn't worth it.
+"""
+
+
+class CompressionSettings:
+    """
+    How Beam compresses outgoing frames, with counters to tune it.
+    `window_bits` and `context_takeover` are asked for during the handshake,
+    None keeps whatever the client offers.
+    """
+
+    def __init__(self, level=6, mem_level=8, window_bits=None, context_takeover=True, min_size=128):
+        # zlib refuses anything else, and only when the first connection is set up
+        if window_bits is not None and not 9 <= window_bits <= 15:
+            raise ValueError(f"compression_window_bits must be between 9 and 15, not {window_bits}")
+        if not -1 <= level <= 9:
+            raise ValueError(f"compression_level must be between -1 and 9, not {level}")
+        if not 1 <= mem_level <= 9:
+            raise ValueError(f"compression_mem_level must be between 1 and 9, not {mem_level}")
+
+        self.level = level
+        self.mem_level = mem_level
+        self.window_bits = window_bits
+        self.context_takeover = context_takeover
+        self.min_size = min_size
+
+        # Counters, for monitoring
+        self.frames = 0
+        self.skipped = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0.0
+
+    def options(self):
+        # Tornado's compression_options
+        return {
+            "compression_level": self.level,
+            "mem_level": self.mem_level
+        }
+
+    def negotiate(self, parameters):
+        # Adjusts the parameters the client offered, Tornado sends them back as the agreed ones
+        if not self.context_takeover:
+            parameters["server_no_context_takeover"] = None
+        if self.window_bits:
+            offered = parameters.get("server_max_window_bits")
+            # Clients may offer 8, which zlib doesn't take for raw deflate
+            bits = self.window_bits if offered is None else max(9, min(int(offered), self.window_bits))
+            parameters["server_max_window_bits"] = str(bits)
+
+
+class MeteredCompressor:
+    """
+    Wraps Tornado's compressor to count bytes and time spent.
+    """
+
+    def __init__(self, compressor, settings: CompressionSettings):
+        self.compressor = compressor
+        self.settings = settings
+
+    def compress(self, data):
+        start = time.perf_counter()
+        compressed = self.compressor.compress(data)
+        self.settings.seconds += time.perf_counter() - start
+        self.settings.frames += 1
+        self.settings.bytes_in += len(data)
+        self.settings.bytes_out += len(compressed)
+        return compressed
+
+
+class DeflateProtocol(tornado.websocket.WebSocketProtocol13):
+    """
+    WebSocket protocol that applies CompressionSettings.
+    """
+
+    def __init__(self, handler, mask_outgoing, params, settings: CompressionSettings):
+        super().__init__(handler, mask_outgoing, params)
+        self.settings = settings
+
+    def _create_compressors(self, side, agreed_parameters, compression_options=None):
+        if side == "server":
+            self.settings.negotiate(agreed_parameters)
+        super()._create_compressors(side, agreed_parameters, compression_options)
+        if side == "server":
+            self._compressor = MeteredCompressor(self._compressor, self.settings)
+
+    def write_message(self, message, binary=False):
+        if self._compressor and len(message) < self.settings.min_size:
+            # An uncompressed frame is allowed, it just doesn't set RSV1
+            self.settings.skipped += 1
+            compressor, self._compressor = self._compressor, None
+            try:
+                return super().write_message(message, binary)
+            finally:
+                self._compressor = compressor
+        return super().write_message(message, binary)
@@ -3,64 +3,74 @@ This is just a holder for returning error codes and whatnot.
 Because .close(code=ServerCodeDoesntExist()) makes more sense than .close(code=4000)
 """
 
-import logging
+from beam import metrics
 BASE = 4000
 
 
+def _counted(code):
+    _COUNTERS[code].inc()
+    return code
+
+
+# Pre-bound children for every code Beam may send
+_COUNTERS = {code: metrics.CLOSE_CODES.labels(code) for code in range(BASE, BASE + 32)}
+
+
 def ServerCodeDoesntExist():
-    logging.debug(f"exception: ServerCodeDoesntExist")
-    return BASE + 0
+    return _counted(BASE + 0)
 
 
 def ServerIsLocked():
-    logging.debug(f"exception: ServerIsLocked")
-    return BASE + 1
+    return _counted(BASE + 1)
 
 
 def NameIsTaken():  # This one happens when you're trying to register and the name is taken
-    logging.debug(f"exception: NameIsTaken")
-    return BASE + 2
+    return _counted(BASE + 2)
 
 
 def NameDoesntExist():  # This one happens when you supply a token code in the login
-    logging.debug(f"exception: # NameDoesntExist")
-    return BASE + 3
+    return _counted(BASE + 3)
 
 
 def TokenCodeMismatch():
-    logging.debug(f"exception: TokenCodeMismatch")
-    return BASE + 4
+    return _counted(BASE + 4)
 
 
 def AdminTokenCodeMismatch():
-    logging.debug(f"exception: AdminTokenCodeMismatch")
-    return BASE + 5
+    return _counted(BASE + 5)
 
 
 def NamePropertyIsEmpty():
-    logging.debug(f"exception: NamePropertyIsEmpty")
-    return BASE + 6
+    return _counted(BASE + 6)
 
 
 def RoomLimitReached():
-    logging.debug(f"exception: RoomLimitReached")
-    return BASE + 7
+    return _counted(BASE + 7)
 
 
 def Overridden():
-    logging.debug(f"exception: Overridden")
-    return BASE + 10
+    return _counted(BASE + 10)
+
+
+def SlowConsumer():  # The client doesn't read its messages fast enough
+    return _counted(BASE + 11)
 
 
 def BreakingApiChange():
-    logging.debug(f"exception: BreakingApiChange")
-    return BASE + 19
+    return _counted(BASE + 19)
 
 
 def ServerClosing():
-    logging.debug(f"exception: ServerClosing")
-    return BASE + 20
+    return _counted(BASE + 20)
+
+
+def Migrating():  # The room moved to another process, reconnect with the same token
+    return _counted(BASE + 21)
 
 
 def BannedByRateLimit():
-    return BASE + 30
+    return _counted(BASE + 30)
+
+
+def Overloaded():  # Beam is too busy for new players right now, try again later
+    return _counted(BASE + 31)
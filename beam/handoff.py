@@ -0,0 +1,119 @@
+import asyncio
+import json
+import logging
+import os
+import struct
+import time
+
+from beam import exceptions, journal
+
+"""
+Handing rooms over to a new Beam process, for deploys without lost games.
+
+The running process listens on a Unix socket. A successor binds the same
+port (SO_REUSEPORT), connects to that socket and asks for the rooms:
+
+    1. the old process drains: it stops accepting connections and new rooms
+    2. it sends a snapshot of every room, as written by beam.journal
+    3. the successor restores them and answers when it's ready
+    4. the old process closes every connection with exceptions.Migrating(),
+       clients reconnect with their tokens and land on the successor
+
+Without a successor, a drained process still closes its connections with
+Migrating after a while, so clients come back to whatever takes its place
+(with beam.journal, the same rooms).
+"""
+
+
+def _write_frame(writer, frame):
+    data = json.dumps(frame).encode()
+    writer.write(struct.pack("!I", len(data)) + data)
+
+
+async def _read_frame(reader):
+    size, = struct.unpack("!I", await reader.readexactly(4))
+    return json.loads(await reader.readexactly(size))
+
+
+def migrate(app):
+    """
+    Closes every connection with Migrating and forgets the rooms,
+    their state lives on somewhere else now.
+    """
+
+    rooms = list(app.pool.pool.values())
+    for server in rooms:
+        app.reaper.disarm(server)
+        app.pool.free(server.code)
+        server.close_server(exceptions.Migrating)
+    logging.info(f"Migrated {len(rooms)} rooms")
+
+
+class HandoffServer:
+    """
+    Gives the rooms of app to the first successor that asks.
+    stop_listening() must close the app's listening sockets.
+    """
+
+    def __init__(self, app, path, stop_listening):
+        self.app = app
+        self.path = path
+        self.stop_listening = stop_listening
+        self.server = None
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.server = await asyncio.start_unix_server(self._connection, self.path)
+
+    async def _connection(self, reader, writer):
+        try:
+            hello = await _read_frame(reader)
+            if hello.get("op") != "take_over":
+                return
+
+            started = time.perf_counter()
+            self.app.drain()
+            self.stop_listening()
+            if self.app.journal:
+                # The successor writes the journal from now on
+                self.app.journal.stop()
+                self.app.journal = None
+
+            rooms = {code: journal.snapshot(server) for code, server in self.app.pool.pool.items()}
+            _write_frame(writer, {"op": "rooms", "rooms": rooms})
+            await writer.drain()
+
+            if (await _read_frame(reader)).get("op") == "ready":
+                self.server.close()
+                logging.info(f"Handed {len(rooms)} rooms over in {time.perf_counter() - started:.3f}s")
+                self.app.migrate()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logging.error("The successor left during the handoff")
+        finally:
+            writer.close()
+
+
+async def take_over(app, path) -> bool:
+    """
+    Takes the rooms of the process listening on path, if there's one.
+    """
+
+    try:
+        reader, writer = await asyncio.open_unix_connection(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        return False
+
+    try:
+        _write_frame(writer, {"op": "take_over"})
+        frame = await _read_frame(reader)
+        journal.restore(app, frame["rooms"])
+        if app.journal:
+            app.journal.compact()
+        _write_frame(writer, {"op": "ready"})
+        await writer.drain()
+    finally:
+        writer.close()
+
+    logging.info(f"Took {len(frame['rooms'])} rooms over from the previous process")
+    return True
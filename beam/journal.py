@@ -0,0 +1,275 @@
+import base64
+import json
+import logging
+import os
+
+import tornado.ioloop
+
+from beam import protocol
+from beam.players import Player
+
+"""
+Append-only journal of rooms, so a restarted Beam keeps its games.
+
+Every line is a JSON record: the whole state of a room (code, tokens,
+settings, players, queued messages) or the removal of one. Only rooms that
+changed since the last write get a new record, later records replace
+earlier ones. Once most of the file is outdated, it's rewritten with only
+the live rooms.
+
+Queued messages are kept as the payloads their recipient was going to get,
+so they're replayed as they are when the client comes back with the same
+protocol version. Room histories (see queues.History) aren't kept, clients
+resuming after a restart are told about the gap.
+"""
+
+
+def _payload(payload, version):
+    # v0 payloads are kept as text, v1 ones in base64
+    if version == 1:
+        return {"b": base64.b64encode(payload).decode()}
+    return payload.decode()
+
+
+def _unpayload(value):
+    if isinstance(value, dict):
+        return base64.b64decode(value["b"]), 1
+    return value.encode(), 0
+
+
+def _entry(encoded, version):
+    # Restored messages only have the payload they were saved with
+    if encoded.message is None:
+        version = next(v for v, payload in enumerate(encoded.payloads) if payload is not None)
+    return _payload(encoded.get(version), version)
+
+
+def _queued(client):
+    entries = []
+    for message, _, _ in client.queue.messages or ():
+        if isinstance(message, protocol.Sequenced):
+            entries.append({"seq": message.seq, "p": _entry(message.encoded, client.version)})
+        else:
+            entries.append({"p": _entry(message, client.version)})
+    return entries
+
+
+def _requeue(client, entries):
+    for entry in entries:
+        payload, version = _unpayload(entry["p"])
+        message = protocol.Encoded(None, payload, version)
+        if "seq" in entry:
+            message = protocol.Sequenced(message, entry["seq"])
+        client.queue.push(message, len(payload))
+
+
+def _client_record(client):
+    return {
+        "token": client.token.hex(),
+        "seq": client.seq,
+        "queue": _queued(client)
+    }
+
+
+def snapshot(server):
+    return {
+        "op": "room",
+        "code": server.code,
+        "limit": server.limit,
+        "lock": server.lock,
+        "p2p": server.p2pmode,
+        "coalesce": [server.coalescer.delay * 1000, server.coalescer.max_bytes] if server.coalescer else None,
+        "owner_ip": server.owner_ip,
+        "owner": _client_record(server),
+        # In index order, so indexes stay the same
+        "players": [dict(_client_record(p), name=p.name) for p in server.players.indexed],
+        "state": server.state,
+        "groups": {name: [p.index for p in members] for name, members in server.players.groups.items()}
+    }
+
+
+def _signature(server):
+    # Changes whenever something is queued for someone
+    return sum(c.queue.size + c.queue.dropped + c.seq for c in [server] + server.players.indexed)
+
+
+class Journal:
+    def __init__(self, path, app, interval=2.0, compact_after=1000):
+        self.path = path
+        self.app = app
+        self.interval = interval
+        # Records written on top of the live rooms before rewriting the file
+        self.compact_after = compact_after
+
+        self.dirty = set()
+        self.closed = []
+        # Rooms with someone away, their queues may change: room -> signature
+        self.watched = {}
+        self.records = 0
+        self.ticker = None
+        self.file = None
+
+    # Marks a room as changed
+    def touch(self, server):
+        self.dirty.add(server)
+        self._schedule()
+
+    def forget(self, server):
+        self.dirty.discard(server)
+        self.watched.pop(server, None)
+        self.closed.append(server.code)
+        self._schedule()
+
+    def _schedule(self):
+        if not self.ticker:
+            self.ticker = tornado.ioloop.PeriodicCallback(self.write, self.interval * 1000)
+            self.ticker.start()
+
+    # Writes what changed, called every interval seconds while something changes
+    def write(self):
+        records = [{"op": "close", "code": code} for code in self.closed]
+        self.closed.clear()
+        for server in self.dirty:
+            records.append(snapshot(server))
+            if server.active_connections < server.players.count() + 1:
+                self.watched[server] = _signature(server)
+            else:
+                self.watched.pop(server, None)
+
+        for server, signature in list(self.watched.items()):
+            if server not in self.dirty and _signature(server) != signature:
+                records.append(snapshot(server))
+                self.watched[server] = _signature(server)
+
+        self.dirty.clear()
+        self._append(records)
+
+        if self.records > len(self.app.pool.pool) * 2 + self.compact_after:
+            self.compact()
+        if self.ticker and not self.watched:
+            self.ticker.stop()
+            self.ticker = None
+
+    def _append(self, records):
+        if not records:
+            return
+        if not self.file:
+            self.file = open(self.path, "a")
+        self.file.write("".join(json.dumps(r) + "\n" for r in records))
+        self.file.flush()
+        self.records += len(records)
+
+    def compact(self):
+        """
+        Rewrites the journal with only the live rooms.
+        """
+
+        temporary = self.path + ".tmp"
+        rooms = list(self.app.pool.pool.values())
+        with open(temporary, "w") as f:
+            for server in rooms:
+                f.write(json.dumps(snapshot(server)) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+        if self.file:
+            self.file.close()
+            self.file = None
+        os.replace(temporary, self.path)
+        self.records = len(rooms)
+        logging.info(f"Compacted the journal, {len(rooms)} rooms")
+
+    def load(self):
+        """
+        The last record of every room still open, by code.
+        """
+
+        rooms = {}
+        if not os.path.exists(self.path):
+            return rooms
+
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A write cut short by a crash
+                    continue
+                self.records += 1
+                if record["op"] == "room":
+                    rooms[record["code"]] = record
+                else:
+                    rooms.pop(record["code"], None)
+        return rooms
+
+    def restore(self):
+        """
+        Recreates the rooms of the journal, see restore.
+        """
+
+        rooms = self.load()
+        restore(self.app, rooms)
+        logging.info(f"Restored {len(rooms)} rooms from {self.path}")
+        self.compact()
+
+    def stop(self):
+        # Writes what's left, nothing is written afterwards
+        self.write()
+        if self.ticker:
+            self.ticker.stop()
+            self.ticker = None
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+def restore(app, rooms):
+    """
+    Recreates rooms from their records (code -> snapshot),
+    players can log back in with their tokens.
+    Rooms nobody comes back to are closed like any empty room.
+    Rooms already in the pool are replaced by their record.
+    """
+
+    app.pool.codes.reserve(rooms)
+
+    for code, record in rooms.items():
+        old = app.pool.get_server_safe(code)
+        if old:
+            _discard(app, old)
+        server = app.pool.add_server(code, record["limit"], **app.room_options(*record.get("coalesce") or ()))
+        server.lock = record["lock"]
+        server.p2pmode = record["p2p"]
+        server.owner_ip = record["owner_ip"]
+        server.state = record.get("state")
+        _restore_client(server, record["owner"])
+
+        for entry in record["players"]:
+            player = Player(entry["name"], None, history=server.history, coalescer=server.coalescer,
+                            **app.client_options())
+            _restore_client(player, entry)
+            server.players[player.name] = player
+
+        for name, indexes in record.get("groups", {}).items():
+            for index in indexes:
+                server.players.join_group(name, server.players.by_index(index))
+
+        app.rate_limits.ip_own(server.owner_ip)
+        if app.bus:
+            app.bus.claim(code)
+        app.close_when_idle(server)
+
+
+# Forgets a room that's replaced without closing it, its code stays in use
+def _discard(app, server):
+    app.reaper.disarm(server)
+    app.rate_limits.ip_deown(server.owner_ip)
+    if app.journal:
+        app.journal.dirty.discard(server)
+        app.journal.watched.pop(server, None)
+
+
+def _restore_client(client, entry):
+    client.token = bytes.fromhex(entry["token"])
+    client.seq = entry["seq"]
+    _requeue(client, entry["queue"])
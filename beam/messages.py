@@ -1,6 +1,12 @@
 from typing import List
 from beam.players import Player
 
+# Connections that ask for at least this protocol revision
+# (the "protocol" query argument) understand batch messages
+BATCH_PROTOCOL = 1
+# and from this one on, sequence numbers (see beam.protocol)
+SEQ_PROTOCOL = 2
+
 
 def Message(from_, data):
     """
@@ -10,15 +16,62 @@ def Message(from_, data):
 
     return {
         "type": "msg",
-        "from": (from_.name if isinstance(from_, Player) else 1),
+        "from": (from_ if isinstance(from_, Player) else 1),
         "data": data
     }
 
 
+def Batch(messages: List[dict]):
+    """
+    Several messages delivered in one frame,
+    only sent to clients that support it
+    """
+
+    return {
+        "type": "batch",
+        "list": messages
+    }
+
+
+def Overflow(missed: int):
+    """
+    Sent to a reconnecting client when messages queued for it
+    had to be thrown away, the client should ask for the full state
+    """
+
+    return {
+        "type": "overflow",
+        "missed": missed
+    }
+
+
+def State(state: dict):
+    """
+    The whole shared state of the room, sent to players arriving in it
+    """
+
+    return {
+        "type": "state",
+        "state": state
+    }
+
+
+def StateDelta(changed: dict, deleted: List[str]):
+    """
+    Keys of the shared state the owner changed or deleted since the last delta
+    """
+
+    return {
+        "type": "delta",
+        "set": changed,
+        "deleted": deleted
+    }
+
+
 def UsersList(users: List[Player]):
     return {
         "type": "users",
-        "list": [u.name for u in users]
+        "list": users
     }
 
 
@@ -31,7 +84,7 @@ def UserJoin(user: Player):
 
     return {
         "type": "joined",
-        "name": user.name
+        "name": user
     }
 
 
@@ -43,7 +96,7 @@ def UserConnected(user: Player):
 
     return {
         "type": "connected",
-        "name": user.name
+        "name": user
     }
 
 
@@ -55,7 +108,7 @@ def UserDisconnected(user: Player):
 
     return {
         "type": "disconnected",
-        "name": user.name
+        "name": user
     }
 
 
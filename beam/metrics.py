@@ -0,0 +1,237 @@
+import bisect
+
+"""
+Prometheus-style metrics, served on /metrics.
+
+Hot paths only touch pre-built metric objects: incrementing a counter or
+observing a histogram doesn't allocate anything. Labelled children are
+created up front and looked up once, never per message.
+Values that can be read from Beam's state (room count, queue lengths...)
+are gathered when /metrics is requested instead, see expose().
+"""
+
+# Buckets in seconds for handling times, in recipients for fan-out sizes
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 1024)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, values)) + "}"
+
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, labels):
+        yield f"{name}{labels} {self.value}"
+
+
+class Gauge(Counter):
+    __slots__ = ()
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        inner = labels[1:-1] + "," if labels else ""
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield f'{name}_bucket{{{inner}le="{bound}"}} {total}'
+        yield f'{name}_bucket{{{inner}le="+Inf"}} {self.count}'
+        yield f"{name}_sum{labels} {self.sum}"
+        yield f"{name}_count{labels} {self.count}"
+
+
+class Family:
+    """
+    A metric with its help text and labelled children.
+    """
+
+    def __init__(self, kind, name, documentation, labelnames=(), buckets=None):
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.children = {}
+        if not labelnames:
+            self.children[()] = self._new()
+
+    def _new(self):
+        if self.kind == "histogram":
+            return Histogram(self.buckets)
+        elif self.kind == "gauge":
+            return Gauge()
+        return Counter()
+
+    # Call this once and keep the child, not on every event
+    def labels(self, *values):
+        values = tuple(str(v) for v in values)
+        if values not in self.children:
+            self.children[values] = self._new()
+        return self.children[values]
+
+    def expose(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.kind}"
+        for values, child in self.children.items():
+            yield from child.samples(self.name, _format_labels(self.labelnames, values))
+
+
+class Registry:
+    def __init__(self):
+        self.families = []
+
+    def add(self, kind, name, documentation, labelnames=(), buckets=None):
+        family = Family(kind, name, documentation, labelnames, buckets)
+        self.families.append(family)
+        return family
+
+    def expose(self):
+        for family in self.families:
+            yield from family.expose()
+
+
+REGISTRY = Registry()
+
+MESSAGES = REGISTRY.add(
+    "counter", "beam_messages_total", "WebSocket packets received, by command", ("command",))
+# Pre-bound children for every command
+COMMANDS = {command: MESSAGES.labels(command) for command in range(32, 44)}
+
+# Unlabelled metrics are used through their only child
+MESSAGE_SECONDS = REGISTRY.add(
+    "histogram", "beam_message_seconds", "Time spent handling a WebSocket packet",
+    buckets=LATENCY_BUCKETS).labels()
+FANOUT = REGISTRY.add(
+    "histogram", "beam_fanout_recipients", "Recipients of a single sent message",
+    buckets=SIZE_BUCKETS).labels()
+COALESCE_SECONDS = REGISTRY.add(
+    "histogram", "beam_coalesce_delay_seconds", "Time messages were held back before being sent together",
+    buckets=LATENCY_BUCKETS).labels()
+COALESCED = REGISTRY.add(
+    "counter", "beam_coalesced_frames_saved_total", "Frames saved by sending held back messages together").labels()
+REAPS = REGISTRY.add(
+    "counter", "beam_inactive_rooms_closed_total", "Rooms closed after staying empty").labels()
+CLOSE_CODES = REGISTRY.add(
+    "counter", "beam_close_codes_total", "Connections closed by Beam, by close code", ("code",))
+
+
+def _family(kind, name, documentation, values, labelname=None):
+    # Builds a throwaway family from values read at scrape time
+    family = Family(kind, name, documentation, (labelname,) if labelname else ())
+    for labels, value in values:
+        family.labels(*labels).value = value
+    return family.expose()
+
+
+def _histogram(name, documentation, buckets, values):
+    histogram = Histogram(buckets)
+    for value in values:
+        histogram.observe(value)
+    yield f"# HELP {name} {documentation}"
+    yield f"# TYPE {name} histogram"
+    yield from histogram.samples(name, "")
+
+
+def expose(app):
+    """
+    Every metric in the Prometheus text format, for the given Beam instance.
+    """
+
+    from beam.queues import MessageQueue
+    from beam.backpressure import FlowControl
+    from beam.spectators import Audience
+
+    servers = list(app.pool.pool.values())
+    clients = servers + [p for s in servers for p in s.players.list()]
+
+    lines = list(REGISTRY.expose())
+    if app.SHARDS > 1:
+        # Every worker counts for itself, see beam.workers
+        lines += _family("gauge", "beam_worker", "Worker these metrics come from",
+                         [((app.SHARD,), 1)], "worker")
+    lines += _family("gauge", "beam_rooms", "Open rooms", [((), len(servers))])
+    lines += _family("gauge", "beam_idle_rooms", "Empty rooms waiting to be closed", [((), len(app.reaper))])
+    lines += _histogram("beam_room_connections", "Connections per room", SIZE_BUCKETS,
+                        (s.active_connections for s in servers))
+    lines += _histogram("beam_queue_length", "Messages queued per client", SIZE_BUCKETS,
+                        (len(c.queue) for c in clients))
+    lines += _family("counter", "beam_queue_dropped_total", "Queued messages thrown away", [
+        (("overflow",), MessageQueue.total_dropped),
+        (("expired",), MessageQueue.total_expired)
+    ], "reason")
+    lines += _family("gauge", "beam_spectators", "Spectators connected",
+                     [((), sum(len(s.spectators) for s in servers if s.spectators))])
+    lines += _family("counter", "beam_spectator_frames_dropped_total", "Frames spectators missed for falling behind",
+                     [((), Audience.total_dropped)])
+    lines += _family("gauge", "beam_buffered_bytes", "Bytes written but not sent yet",
+                     [((), FlowControl.total_buffered)])
+    lines += _family("counter", "beam_slow_clients_total", "Actions taken against slow clients", [
+        (("pause",), app.flow.pauses),
+        (("drop",), app.flow.dropped),
+        (("disconnect",), app.flow.disconnects)
+    ], "action")
+
+    lines += _family("gauge", "beam_rate_limit_buckets", "IPs tracked by the rate limiter",
+                     [((), len(app.rate_limits))])
+    lines += _family("counter", "beam_rate_limited_total", "Actions refused by the rate limiter",
+                     [((), app.rate_limits.denied)])
+
+    lines += _family("gauge", "beam_loop_lag_seconds", "Recent event loop lag",
+                     [((), app.admission.lag)])
+    lines += _family("gauge", "beam_shedding", "Whether newcomers are turned away",
+                     [((), int(app.admission.shedding))])
+    lines += _family("counter", "beam_shed_total", "Newcomers turned away while overloaded", [
+        (("room",), app.admission.rejected_rooms),
+        (("player",), app.admission.rejected_players)
+    ], "kind")
+
+    if app.compression:
+        settings = app.compression
+        lines += _family("counter", "beam_compression_frames_total", "Outgoing frames", [
+            (("compressed",), settings.frames),
+            (("skipped",), settings.skipped)
+        ], "result")
+        lines += _family("counter", "beam_compression_bytes_total", "Bytes going through deflate", [
+            (("in",), settings.bytes_in),
+            (("out",), settings.bytes_out)
+        ], "direction")
+        lines += _family("counter", "beam_compression_seconds_total", "Time spent compressing",
+                         [((), settings.seconds)])
+
+    if app.bus:
+        lines += _family("gauge", "beam_bus_latency_seconds", "Average latency of bus batches", [
+            (("to_broker",), app.bus.to_broker.average),
+            (("from_broker",), app.bus.from_broker.average)
+        ], "hop")
+        lines += _family("counter", "beam_bus_batches_total", "Batches sent over the bus",
+                         [((), app.bus.batches_sent)])
+        lines += _family("counter", "beam_bus_items_total", "Items sent over the bus in batches",
+                         [((), app.bus.items_sent)])
+
+    return "\n".join(lines) + "\n"
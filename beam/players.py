@@ -1,42 +1,194 @@
-from asyncio import exceptions
 from typing import List
-from beam import messages
+from beam import messages, exceptions, protocol, tracing
+from beam.queues import MessageQueue
+from beam.backpressure import FlowControl
+import hmac
 import uuid
-import json
-import logging
 
 
 class Client:
-    def __init__(self, client) -> None:
+    # Slotted, there can be a lot of these
+    __slots__ = ("client", "token", "queue", "flow", "buffered", "paused", "seq", "history", "coalescer")
+
+    def __init__(self, client, queue=None, flow=None, history=None, coalescer=None) -> None:
         self.client = client
-        self.token = str(uuid.uuid4())
+        # The 16 bytes of a UUID, see token_text
+        self.token = uuid.uuid4().bytes
+
+        # Messages waiting for the client to come back
+        self.queue = queue if queue is not None else MessageQueue()
+
+        # Bytes written to the current connection but not sent yet
+        self.flow = flow if flow is not None else FlowControl()
+        self.buffered = 0
+        self.paused = False
+
+        # Last sequence number sent, and the room's history (queues.History)
+        self.seq = 0
+        self.history = history
+
+        # Holds messages back to send them together, see beam.coalescing
+        self.coalescer = coalescer
+
+    # The token as clients see it
+    @property
+    def token_text(self):
+        return str(uuid.UUID(bytes=self.token))
+
+    def token_matches(self, text) -> bool:
+        try:
+            return hmac.compare_digest(uuid.UUID(text).bytes, self.token)
+        except (TypeError, ValueError):
+            return False
 
-        self.queue = []
-    
     # This is used when something sends a message TO this player
     def write_message(self, message):
+        self.write_encoded(protocol.Encoded(message))
+
+    # Same as write_message, for a protocol.Encoded message.
+    # This lets many recipients share one encoding.
+    # Non-essential messages (relayed ones) may be dropped for slow clients.
+    def write_encoded(self, encoded, essential=True):
+        # Numbered before anything can drop it, so the client sees the gap
+        if self.history is not None and self.sequenced and not isinstance(encoded, protocol.Sequenced):
+            self.seq += 1
+            encoded = protocol.Sequenced(encoded, self.seq)
+            self.history.record(self, encoded)
+
+        if not self.paused and self.buffered >= self.flow.high_water:
+            if self.flow.policy == "drop":
+                if not essential:
+                    self.flow.dropped += 1
+                    return
+            elif self.flow.policy == "pause":
+                self.paused = True
+                self.flow.pauses += 1
+            elif self.flow.policy == "disconnect":
+                self.paused = True
+                self.flow.disconnects += 1
+                tracing.trace("slow_client", getattr(self.client, "code", None), buffered=self.buffered)
+                self.client.close(code=exceptions.SlowConsumer())
+
+            # What was held back goes before what gets queued now
+            if self.paused and self.coalescer is not None:
+                self.coalescer.release(self)
+
+        payload = encoded.get(self.version)
+        if self.coalescer is not None and not self.paused and self.batching:
+            self.coalescer.hold(self, encoded, payload)
+        elif self.paused or not self._send(payload):
+            self.queue.push(encoded, len(payload))
+
+    # Writes to the connection, returns False if that's not possible
+    def _send(self, payload):
         try:
-            self.client.write_message(json.dumps(message))
+            future = self.client.write_message(payload, binary=self.version == 1)
         except:
-            self.queue.append(message)
+            return False
+
+        if future is not None:
+            client, size = self.client, len(payload)
+            self.buffered += size
+            FlowControl.total_buffered += size
+            future.add_done_callback(
+                lambda f: self._written(client, size, f))
+        return True
+
+    def _written(self, client, size, future):
+        # Retrieve the error of closed connections so asyncio doesn't complain
+        if not future.cancelled():
+            future.exception()
 
-    # This is used when THIS PLAYER sends something to someone else
+        FlowControl.total_buffered -= size
+        if client is self.client:
+            self.buffered -= size
+            if self.paused and self.buffered <= self.flow.low_water:
+                self.paused = False
+                self._replay()
+
+    # This is used when THIS PLAYER sends something to someone else.
+    # The content is only encoded once, no matter how many recipients there are.
     def sends_message(self, to, content):
-        if isinstance(to, PlayerPool):
-            for recipient in to.list():
-                self.sends_message(recipient, content)
-        else:
-            to.write_message(content)
+        encoded = protocol.Encoded(content)
+        for recipient in recipients(to):
+            recipient.write_encoded(encoded, essential=False)
+        return encoded
     
-    def assign(self, client):
+    # Sends several messages at once. `deliveries` maps every recipient to
+    # the list of messages meant for it. Recipients that understand batches
+    # get all of them in a single frame, identical frames are encoded once.
+    def sends_batch(self, deliveries):
+        encodings = {}
+
+        def encode(batch):
+            key = tuple(map(id, batch))
+            if key not in encodings:
+                encodings[key] = protocol.Encoded(
+                    batch[0] if len(batch) == 1 else messages.Batch(batch))
+            return encodings[key]
+
+        for recipient, batch in deliveries.items():
+            if recipient.batching:
+                recipient.write_encoded(encode(batch), essential=False)
+            else:
+                for message in batch:
+                    recipient.write_encoded(encode([message]), essential=False)
+
+    # Protocol version of the current connection, see beam.protocol
+    @property
+    def version(self):
+        return getattr(self.client, "version", 0)
+
+    # Whether the current connection accepts batch messages
+    @property
+    def batching(self):
+        return self.version >= 1 or getattr(self.client, "protocol", 0) >= messages.BATCH_PROTOCOL
+
+    # Whether the current connection gets sequence numbers
+    @property
+    def sequenced(self):
+        return getattr(self.client, "protocol", 0) >= messages.SEQ_PROTOCOL
+
+    # resume_from is the last sequence number the client has seen
+    def assign(self, client, resume_from=None):
         try:
             self.client.close(code=exceptions.Overridden())
         except:
             pass
 
+        # Held back for the old connection, and newer than what's queued
+        if self.coalescer is not None:
+            for encoded, payload in self.coalescer.take(self):
+                self.queue.push(encoded, len(payload))
+
         self.client = client
-        while len(self.queue) > 0:
-            self.write_message(self.queue.pop(0))
+        self.buffered = 0
+        self.paused = False
+        self._replay(resume_from)
+
+    # Sends everything that was queued, in one frame if possible
+    def _replay(self, resume_from=None):
+        missed, queued = self.queue.drain()
+        if resume_from is not None and self.history is not None and self.sequenced:
+            # The history also has what the old connection may have lost
+            missed, queued = self.history.since(self, resume_from, self.seq, queued)
+            if missed:
+                queued.insert(0, protocol.Encoded(messages.Overflow(missed)))
+        elif missed and self.queue.policy == "collapse":
+            queued.insert(0, protocol.Encoded(messages.Overflow(missed)))
+
+        if self.batching and len(queued) > 1:
+            self.send_together(queued, [encoded.get(self.version) for encoded in queued])
+        else:
+            for encoded in queued:
+                self.write_encoded(encoded)
+
+    # Sends encoded messages in one frame, or queues them if that's not possible
+    def send_together(self, queued, payloads):
+        payload = payloads[0] if len(payloads) == 1 else protocol.join_batch(payloads, self.version)
+        if not self._send(payload):
+            for encoded, payload in zip(queued, payloads):
+                self.queue.push(encoded, len(payload))
 
 
 class Player(Client):
@@ -44,9 +196,13 @@ class Player(Client):
     A member of a game room.
     """
 
-    def __init__(self, name: str, client):
-        super().__init__(client)
+    __slots__ = ("name", "index")
+
+    def __init__(self, name: str, client, **options):
+        super().__init__(client, **options)
         self.name = str(name)
+        # Position in the PlayerPool, used instead of the name by protocol v1
+        self.index = None
 
 
 class PlayerPool:
@@ -54,11 +210,19 @@ class PlayerPool:
     Holder class for a list of players connected to a server.
     """
 
+    __slots__ = ("players", "indexed", "groups")
+
     def __init__(self):
         self.players = {}
+        self.indexed = []
+        # Named groups set up by the owner: name -> {player: None}, in joining order
+        self.groups = {}
 
     # For subscript access
     def __setitem__(self, player_name, player):
+        if player_name not in self.players:
+            player.index = len(self.indexed)
+            self.indexed.append(player)
         self.players[player_name] = player
 
     def __getitem__(self, player_name):
@@ -68,8 +232,44 @@ class PlayerPool:
     def __contains__(self, what):
         return what in self.players
 
+    def by_index(self, index):
+        if 0 <= index < len(self.indexed):
+            return self.indexed[index]
+        return None
+
     def list(self) -> List[Player]:
         return list(self.players.values())
 
+    def group(self, name) -> List[Player]:
+        return list(self.groups.get(name, ()))
+
+    def join_group(self, name, player):
+        self.groups.setdefault(name, {})[player] = None
+
+    def leave_group(self, name, player):
+        members = self.groups.get(name)
+        if members is not None:
+            members.pop(player, None)
+            if not members:
+                del self.groups[name]
+
+    def delete_group(self, name):
+        self.groups.pop(name, None)
+
     def count(self):
         return len(self.players)
+
+
+def recipients(to) -> List[Client]:
+    """
+    Turns a message destination (a single Client, a PlayerPool
+    or a list of Clients) into a list of Clients.
+    """
+
+    if isinstance(to, PlayerPool):
+        return to.list()
+    elif isinstance(to, Client):
+        return [to]
+    else:
+        return [r for r in to if r is not None]
+
@@ -0,0 +1,375 @@
+import re
+import struct
+
+from beam import codec
+
+"""
+Wire formats of the WebSocket endpoint, chosen by the /ws/<version> path.
+
+v0 - text frames, a command character followed by JSON,
+     messages are JSON objects
+v1 - binary frames, see below
+
+v0 destinations ("to"): 1 for the owner, 2 for everyone, a player name,
+{"group": name} for a group the owner set up with commands 40 and 41
+({"group": name, "players": [names]}), or a list of any of these.
+Every recipient gets the message once, however many times it's listed.
+
+Shared state: the owner sets keys of a room-wide JSON object with command
+42 ({key: value, ...}) and deletes them with command 43 ([key, ...]).
+Players get what changed as one delta message per event loop iteration,
+and the whole state when they join or log back in.
+
+Relay mode (v0 command 39) skips decoding the content of a message:
+    '<to as JSON>\n<content>
+The content is pasted into outgoing messages as it is. It's only checked
+to be exactly one JSON value, otherwise it could add keys to the message
+around it (a forged "from" or "type") or messages to a batch, frames
+that aren't are refused like any invalid JSON. v1 content is always
+forwarded untouched.
+
+Sequence numbers (the "protocol" query argument set to 2 or more):
+every frame sent to the client is numbered, starting at 1 and going on
+across reconnections. v0 frames get a "seq" key, v1 frames are wrapped in
+a seq frame. Reconnecting with resume_from=<last seq received> replays
+what came after it in one batch, preceded by an overflow message when
+some of it isn't kept anymore. Batches are never nested: the messages of
+a queued or replayed batch are spliced into the one it's sent in, its
+sequence number going on the last of them.
+
+Messages are built as dicts by beam.messages and encoded here for every
+protocol version a recipient uses. Players are kept as Player objects in
+those dicts until they're encoded, v0 writes their names and v1 their index.
+Payloads of both versions are bytes (v0 ones are UTF-8 JSON, see beam.codec),
+whether a frame is text or binary depends on the recipient's version.
+
+v1 incoming frames:
+    [u8 command] followed by
+    33: [to][content...]
+    34: ([to][u32 content length][content])*
+    40: [str group]([u32 index])*   adds players to a group
+    41: [str group]([u32 index])*   removes them, or the whole group without any
+    42: [json object]   sets keys of the room's shared state
+    43: [json list]     deletes keys of the shared state
+    other commands have no payload
+
+    to: [u8 1] owner, [u8 2] everyone,
+        [u8 3][str name] a player by name, [u8 4][u32 index] a player by index,
+        [u8 5][u16 count]([to])* several of these, [u8 6][str group] a group
+
+v1 outgoing frames, [u8 type] followed by
+    1 msg:          [u32 from][data...]   from is 0 for the owner, index + 1 for players
+    2 users:        [u32 count][str name]*   in index order
+    3 joined:       [u32 index][str name]
+    4 connected:    [u32 index][str name]
+    5 disconnected: [u32 index][str name]
+    6 token:        [str token]
+    7 batch:        [u32 count]([u32 length][frame])*
+    8 overflow:     [u32 missed]
+    9 seq:          [u32 seq][frame]
+    10 state:       [json state]
+    11 delta:       [json {"set": {...}, "deleted": [...]}]
+    0 anything else, as JSON: [json...]
+
+str is [u16 length][utf-8], integers are big endian.
+Message data is passed through as raw bytes.
+"""
+
+VERSIONS = ("v0", "v1")
+
+TO_OWNER = 1
+TO_EVERYONE = 2
+TO_NAME = 3
+TO_INDEX = 4
+TO_LIST = 5
+TO_GROUP = 6
+
+TYPES = {
+    "msg": 1,
+    "users": 2,
+    "joined": 3,
+    "connected": 4,
+    "disconnected": 5,
+    "token": 6,
+    "batch": 7,
+    "overflow": 8,
+    "seq": 9,
+    "state": 10,
+    "delta": 11
+}
+
+_u16 = struct.Struct("!H")
+_u32 = struct.Struct("!I")
+
+
+class PlayerIndex(int):
+    """
+    A message destination given as a player's index instead of their name.
+    """
+
+
+class Group(str):
+    """
+    A message destination given as the name of a group of players.
+    """
+
+
+class Raw(str):
+    """
+    Message content in relay mode, JSON text that is never parsed.
+    """
+
+
+class Encoded:
+    """
+    A message along with its encodings.
+    Every encoding is made once, on first use, and shared by all recipients.
+    """
+
+    __slots__ = ("message", "payloads")
+
+    def __init__(self, message, payload=None, version=0):
+        self.message = message
+        self.payloads = [None] * len(VERSIONS)
+        if payload is not None:
+            self.payloads[version] = payload
+
+    def get(self, version: int):
+        payload = self.payloads[version]
+        if payload is None:
+            if self.message is None:
+                # Only the payload was kept (see beam.journal), send it as it is
+                return next(p for p in self.payloads if p is not None)
+            payload = self.payloads[version] = encode(self.message, version)
+        return payload
+
+
+class Sequenced:
+    """
+    An Encoded message as sent to one recipient, with its sequence number.
+    """
+
+    __slots__ = ("encoded", "seq")
+
+    def __init__(self, encoded: Encoded, seq: int):
+        self.encoded = encoded
+        self.seq = seq
+
+    def get(self, version: int):
+        return with_seq(self.encoded.get(version), self.seq, version)
+
+
+def with_seq(payload, seq: int, version: int):
+    if version == 0:
+        # Every v0 payload is a JSON object
+        return b'{"seq": ' + str(seq).encode() + b", " + payload[1:]
+    else:
+        return bytes((TYPES["seq"],)) + _u32.pack(seq) + payload
+
+
+def encode(message, version: int):
+    if version == 0:
+        return _encode_v0(message)
+    else:
+        return _encode_v1(message)
+
+
+def join_batch(payloads, version: int):
+    """
+    Builds a batch message out of already encoded messages,
+    without decoding them again. Batches among them are spliced in,
+    a batch never contains another one.
+    """
+
+    parts = []
+    for payload in payloads:
+        parts += _batch_parts(payload, version)
+    return _join(parts, version)
+
+
+def _join(payloads, version: int):
+    if version == 0:
+        return b'{"type": "batch", "list": [' + b", ".join(payloads) + b"]}"
+    else:
+        parts = [bytes((TYPES["batch"],)), _u32.pack(len(payloads))]
+        for payload in payloads:
+            parts.append(_u32.pack(len(payload)))
+            parts.append(payload)
+        return b"".join(parts)
+
+
+# v0 batches as _join makes them, maybe with a sequence number
+_V0_BATCH = re.compile(rb'\{(?:"seq": \d+, )?"type": "batch", "list": \[')
+
+
+def _batch_parts(payload, version: int):
+    """
+    The messages of a batch payload, or the payload itself.
+    A batch's sequence number goes to its last message, clients
+    resuming from it have seen all of them.
+    """
+
+    seq = None
+    if version == 0:
+        if not _V0_BATCH.match(payload):
+            return [payload]
+        # Rare enough (batches that were queued or held back) to decode them
+        batch = codec.loads(payload)
+        parts = [codec.dumps(m) for m in batch["list"]]
+        seq = batch.get("seq")
+    else:
+        if payload[0] == TYPES["seq"] and len(payload) > 5 and payload[5] == TYPES["batch"]:
+            seq, = _u32.unpack_from(payload, 1)
+            payload = payload[5:]
+        elif payload[0] != TYPES["batch"]:
+            return [payload]
+        parts = []
+        offset = 5
+        while offset < len(payload):
+            length, = _u32.unpack_from(payload, offset)
+            parts.append(payload[offset + 4:offset + 4 + length])
+            offset += 4 + length
+
+    if seq is not None and parts:
+        parts[-1] = with_seq(parts[-1], seq, version)
+    return parts
+
+
+def _encode_v0(message) -> bytes:
+    kind = message["type"]
+    if kind == "msg" and isinstance(message["data"], Raw):
+        return b'{"type": "msg", "from": ' + codec.dumps(message["from"]) + b', "data": ' + message["data"].encode() + b"}"
+    elif kind == "batch":
+        return _join([_encode_v0(m) for m in message["list"]], 0)
+    return codec.dumps(message)
+
+
+def _str(value: str) -> bytes:
+    data = value.encode()
+    return _u16.pack(len(data)) + data
+
+
+def _player(player) -> bytes:
+    return _u32.pack(player.index) + _str(player.name)
+
+
+def _encode_v1(message) -> bytes:
+    kind = message["type"]
+    code = TYPES.get(kind, 0)
+    head = bytes((code,))
+
+    if kind == "msg":
+        sender = message["from"]
+        data = message["data"]
+        if isinstance(data, Raw):
+            data = data.encode()
+        elif not isinstance(data, (bytes, bytearray, memoryview)):
+            # Sent by a v0 client
+            data = codec.dumps(data)
+        return head + _u32.pack(0 if sender == 1 else sender.index + 1) + data
+
+    elif kind == "users":
+        return head + _u32.pack(len(message["list"])) + b"".join(_str(u.name) for u in message["list"])
+
+    elif kind in ("joined", "connected", "disconnected"):
+        return head + _player(message["name"])
+
+    elif kind == "token":
+        return head + _str(message["token"])
+
+    elif kind == "batch":
+        return _join([_encode_v1(m) for m in message["list"]], 1)
+
+    elif kind == "overflow":
+        return head + _u32.pack(message["missed"])
+
+    elif kind == "state":
+        return head + codec.dumps(message["state"])
+
+    elif kind == "delta":
+        return head + codec.dumps({"set": message["set"], "deleted": message["deleted"]})
+
+    return head + codec.dumps(message)
+
+
+def _decode_str(frame: bytes, offset: int):
+    length, = _u16.unpack_from(frame, offset)
+    offset += 2
+    return str(frame[offset:offset + length], "utf-8"), offset + length
+
+
+def _decode_to(frame: bytes, offset: int):
+    kind = frame[offset]
+    offset += 1
+    if kind == TO_OWNER:
+        return 1, offset
+    elif kind == TO_EVERYONE:
+        return 2, offset
+    elif kind == TO_NAME:
+        return _decode_str(frame, offset)
+    elif kind == TO_INDEX:
+        index, = _u32.unpack_from(frame, offset)
+        return PlayerIndex(index), offset + 4
+    elif kind == TO_LIST:
+        count, = _u16.unpack_from(frame, offset)
+        offset += 2
+        destinations = []
+        for _ in range(count):
+            to, offset = _decode_to(frame, offset)
+            destinations.append(to)
+        return destinations, offset
+    elif kind == TO_GROUP:
+        name, offset = _decode_str(frame, offset)
+        return Group(name), offset
+    raise ValueError(f"Unknown destination kind: {kind}")
+
+
+def decode_relay(message: str):
+    """
+    Reads a v0 relay mode message, only the destination gets parsed.
+    """
+
+    newline = message.index("\n", 1)
+    content = message[newline + 1:]
+    # Raises a ValueError for anything but one complete JSON value
+    codec.loads(content)
+    return {
+        "to": codec.loads(message[1:newline]),
+        "content": Raw(content)
+    }
+
+
+def decode_v1(frame: bytes):
+    """
+    Splits an incoming v1 frame into its command and data,
+    data being shaped like the JSON of the same v0 command.
+    Contents are views into the frame, they aren't copied.
+    """
+
+    command = frame[0]
+    data = None
+    frame = memoryview(frame)
+
+    if command == 33:
+        to, offset = _decode_to(frame, 1)
+        data = {"to": to, "content": frame[offset:]}
+
+    elif command == 34:
+        data = []
+        offset = 1
+        while offset < len(frame):
+            to, offset = _decode_to(frame, offset)
+            length, = _u32.unpack_from(frame, offset)
+            offset += 4
+            data.append({"to": to, "content": frame[offset:offset + length]})
+            offset += length
+
+    elif command == 40 or command == 41:
+        group, offset = _decode_str(frame, 1)
+        players = [PlayerIndex(i) for i, in _u32.iter_unpack(frame[offset:])]
+        data = {"group": group, "players": players}
+
+    elif command == 42 or command == 43:
+        data = codec.loads(frame[1:])
+
+    return command, data
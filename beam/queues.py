@@ -0,0 +1,182 @@
+import collections
+import time
+
+from beam import protocol
+
+"""
+Queue for messages that couldn't be delivered because the recipient is away,
+and history of the messages a room sent, for clients resuming a connection.
+"""
+
+# What happens when a full queue receives another message:
+# "oldest"   - the oldest queued message is dropped
+# "newest"   - the incoming message is dropped
+# "collapse" - the whole backlog is dropped and the client is told
+#              how many messages it missed, so it can resync
+POLICIES = ("oldest", "newest", "collapse")
+
+
+class MessageQueue:
+    """
+    Bounded FIFO of messages (protocol.Encoded) and their sizes.
+    Limits the number of messages, their total size and how long they're kept.
+    """
+
+    # Totals across every queue, for monitoring
+    total_dropped = 0
+    total_expired = 0
+
+    __slots__ = ("max_messages", "max_bytes", "ttl", "policy", "messages", "size",
+                 "missed", "dropped", "expired")
+
+    def __init__(self, max_messages=1000, max_bytes=512 * 1024, ttl=120, policy="oldest"):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown queue policy: {policy}")
+
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.policy = policy
+
+        # (message, size, expires_at), only created when something is queued
+        self.messages = None
+        self.size = 0
+
+        # Messages lost since the last drain, reported to the client on collapse
+        self.missed = 0
+        self.dropped = 0
+        self.expired = 0
+
+    def __len__(self):
+        self._expire()
+        return len(self.messages) if self.messages else 0
+
+    def _expire(self):
+        if not self.ttl:
+            return
+        now = time.monotonic()
+        while self.messages and self.messages[0][2] <= now:
+            self._pop()
+            self.expired += 1
+            self.missed += 1
+            MessageQueue.total_expired += 1
+
+    def _pop(self):
+        _, size, _ = self.messages.popleft()
+        self.size -= size
+
+    def _drop(self, count=1):
+        self.dropped += count
+        self.missed += count
+        MessageQueue.total_dropped += count
+
+    def _full(self, size):
+        return len(self) >= self.max_messages or self.size + size > self.max_bytes
+
+    def push(self, message, size):
+        self._expire()
+        if self.messages is None:
+            self.messages = collections.deque()
+
+        if self._full(size):
+            if self.policy == "collapse":
+                self._drop(len(self.messages))
+                self.messages.clear()
+                self.size = 0
+            elif self.policy == "oldest":
+                while self.messages and self._full(size):
+                    self._pop()
+                    self._drop()
+
+            if self._full(size):
+                self._drop()
+                return
+
+        expires_at = time.monotonic() + self.ttl if self.ttl else float("inf")
+        self.messages.append((message, size, expires_at))
+        self.size += size
+
+    # Empties the queue, returns the number of lost messages and the messages
+    def drain(self):
+        self._expire()
+        missed = self.missed
+        queued = [message for message, _, _ in self.messages or ()]
+
+        self.messages = None
+        self.size = 0
+        self.missed = 0
+        return missed, queued
+
+
+class History:
+    """
+    Ring buffer of the last size messages sent to the sequenced clients
+    of a room, shared by all of them. A message is kept once, and which
+    clients got it with which sequence number is kept per client as runs:
+    a client's numbers go up by one with every message, so as long as it
+    gets every message (broadcasts) a single run covers all of them.
+    """
+
+    __slots__ = ("size", "entries", "count", "runs")
+
+    def __init__(self, size=256):
+        self.size = size
+        # protocol.Encoded messages, only created when something is recorded.
+        # count is how many were ever recorded, the id of the next one.
+        self.entries = None
+        self.count = 0
+        # client: [[first entry id, first seq, length], ...]
+        self.runs = None
+
+    def __len__(self):
+        return len(self.entries) if self.entries else 0
+
+    def record(self, client, message):
+        if not self.size:
+            return
+        if self.entries is None:
+            self.entries = collections.deque(maxlen=self.size)
+            self.runs = {}
+        runs = self.runs.setdefault(client, [])
+        last = runs[-1] if runs else None
+
+        # Recipients of a message are numbered one after the other
+        if not (self.entries and self.entries[-1] is message.encoded
+                and not (last and last[0] + last[2] == self.count)):
+            self.entries.append(message.encoded)
+            self.count += 1
+            # Every size messages, forget clients that got none of the kept ones
+            if self.count % self.size == 0:
+                self._prune(client)
+        entry = self.count - 1
+
+        if last and last[0] + last[2] == entry and last[1] + last[2] == message.seq:
+            last[2] += 1
+        else:
+            runs.append([entry, message.seq, 1])
+            first = self.count - len(self.entries)
+            while runs[0][0] + runs[0][2] <= first:
+                del runs[0]
+
+    def _prune(self, keep):
+        first = self.count - len(self.entries)
+        for client in [c for c, runs in self.runs.items() if c is not keep and runs[-1][0] + runs[-1][2] <= first]:
+            del self.runs[client]
+
+    def since(self, client, seq, last, queued=()):
+        """
+        Messages sent to client after seq, up to last, and how many of those
+        aren't kept anymore. Messages queued for the client come first,
+        the history only fills in what the queue lost.
+        """
+
+        found = {m.seq: m for m in queued if isinstance(m, protocol.Sequenced) and m.seq > seq}
+        first = self.count - len(self)
+        for entry, number, length in (self.runs or {}).get(client, ()):
+            for i in range(max(0, first - entry, seq + 1 - number), length):
+                if number + i not in found:
+                    found[number + i] = protocol.Sequenced(self.entries[entry + i - first], number + i)
+
+        # Queued before the client got sequence numbers, never sent
+        unnumbered = [m for m in queued if not isinstance(m, protocol.Sequenced)]
+        return max(0, last - seq - len(found)), unnumbered + [found[n] for n in sorted(found)]
@@ -1,27 +1,110 @@
-class JoinLimiter:
-    def __init__(self):
-        self.strikes = 0
-        self.striking_test = 0
+import collections
+import time
+
+"""
+Rate limiting shared by every room.
+
+Every (IP, scope) pair gets a token bucket: a scope allows `limit` actions
+per `per_seconds`, in bursts of up to `limit`. Buckets are kept in an LRU of
+bounded size, and a bucket that has refilled (and isn't banned) is dropped,
+since a new one would be the same.
+"""
+
+
+class Bucket:
+    __slots__ = ("tokens", "updated", "banned_until")
+
+    def __init__(self, tokens, updated):
+        self.tokens = tokens
+        self.updated = updated
         self.banned_until = 0
 
 
-class RoomJoinLimiting:
-    def __init__(self):
-        self.ips = {
-            "0.0.0.0": JoinLimiter()
-        }
+class Scope:
+    __slots__ = ("rate", "burst", "ban_for")
+
+    def __init__(self, limit, per_seconds, ban_for):
+        self.rate = limit / per_seconds
+        self.burst = limit
+        self.ban_for = ban_for
+
+
+class RateLimiter:
+    def __init__(self, max_entries=65536):
+        self.scopes = {}
+        self.buckets = collections.OrderedDict()
+        self.max_entries = max_entries
+
+        self.denied = 0
+        self.evicted = 0
+
+        # Rooms owned by every IP
+        self.owns = {}
+
+    def scope(self, name, limit, per_seconds, ban_for=0):
+        """
+        Allows limit actions per per_seconds, going over it bans the IP
+        from the scope for ban_for seconds.
+        """
+
+        self.scopes[name] = Scope(limit, per_seconds, ban_for)
+
+    def allow(self, ip, scope, now=None) -> bool:
+        """
+        Takes a token for the action, False means it should be refused.
+        """
+
+        if now is None:
+            now = time.monotonic()
+        settings = self.scopes[scope]
+        key = (ip, scope)
+
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            self._evict(now)
+            bucket = self.buckets[key] = Bucket(settings.burst, now)
+        else:
+            self.buckets.move_to_end(key)
+            bucket.tokens = min(settings.burst, bucket.tokens + (now - bucket.updated) * settings.rate)
+            bucket.updated = now
+
+        if now < bucket.banned_until:
+            self.denied += 1
+            return False
+
+        if bucket.tokens >= 1:
+            bucket.tokens -= 1
+            return True
+
+        if settings.ban_for:
+            bucket.banned_until = now + settings.ban_for
+        self.denied += 1
+        return False
+
+    def _idle(self, key, bucket, now):
+        settings = self.scopes[key[1]]
+        return now >= bucket.banned_until and \
+            bucket.tokens + (now - bucket.updated) * settings.rate >= settings.burst
 
-    def get_ratelimit_data(self, ip):
-        if not ip in self.ips:
-            self.ips[ip] = JoinLimiter()
-        return self.ips[ip]
+    def _evict(self, now):
+        # Least recently used first, so checking the oldest few is enough
+        for _ in range(2):
+            if not self.buckets:
+                return
+            key, bucket = next(iter(self.buckets.items()))
+            if not self._idle(key, bucket, now):
+                break
+            del self.buckets[key]
 
+        # Under a flood of new IPs, even active buckets have to go
+        while len(self.buckets) >= self.max_entries:
+            self.buckets.popitem(last=False)
+            self.evicted += 1
 
-class RoomCreateLimiting:
-    def __init__(self):
-        self.owns = {
+    def __len__(self):
+        return len(self.buckets)
 
-        }
+    # Room ownership, a count rather than a rate
 
     def check_ip_owns(self, ip):
         return self.owns.get(ip, 0)
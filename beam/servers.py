@@ -1,9 +1,9 @@
 import logging
-from beam import exceptions, ratelimiting
+from beam import exceptions
 from beam.players import Player, PlayerPool, Client
-import random
-import string
-from beam import messages
+import zlib
+import tornado.ioloop
+from beam import messages, protocol, codes, tracing
 
 """
 Classes for the servers.
@@ -11,8 +11,11 @@ Classes for the servers.
 
 
 class Server(Client):
-    def __init__(self, code: str, limit: int):
-        super().__init__(None)
+    __slots__ = ("code", "players", "lock", "limit", "p2pmode", "active_connections", "owner_ip",
+                 "state", "delta", "spectators")
+
+    def __init__(self, code: str, limit: int, **options):
+        super().__init__(None, **options)
 
         self.code = code
 
@@ -23,25 +26,71 @@ class Server(Client):
         self.active_connections = 0
 
         self.owner_ip = None
-        self.rate_limit = ratelimiting.RoomJoinLimiting()
 
-        self.close_task = None
+        # Shared key/value state, only for rooms that use it.
+        # Changes wait in delta ({changed key: value}, {deleted key: None})
+        # until the end of the event loop iteration.
+        self.state = None
+        self.delta = None
+
+        # Read-only viewers (spectators.Audience), only for rooms that have some
+        self.spectators = None
 
-        logging.debug(f"Initialized new Server instance: {self.code}")
+        tracing.trace("room_created", self.code)
 
     # Add a Player to the PlayerPool
     def add_user(self, player: Player):
         if not player.name in self.players:
-            message = messages.UserJoin(player)
-            self.client.write_message(message)
-            if self.p2pmode:
-                for p in self.players.list():
-                    p.write_message(message)
+            others = self.players.list()
             self.players[player.name] = player
-            logging.debug(f"Server {self.code} adds new player {player}")
+
+            message = protocol.Encoded(messages.UserJoin(player))
+            self.write_encoded(message)
+            if self.p2pmode:
+                for p in others:
+                    p.write_encoded(message)
+            if tracing.TRACER.active:
+                tracing.trace("player_added", self.code, player=player.name)
         else:
-            logging.error(
-                f"Server {self.code} tried to add player {player} but the name is taken. Did an earlier check fail?")
+            logging.error("Server %s tried to add player %s but the name is taken. Did an earlier check fail?",
+                          self.code, player)
+
+    def set_state(self, values: dict):
+        if self.state is None:
+            self.state = {}
+        for key, value in values.items():
+            if key in self.state and self.state[key] == value:
+                continue
+            self.state[key] = value
+            changed, deleted = self._delta()
+            changed[key] = value
+            deleted.pop(key, None)
+
+    def delete_state(self, keys):
+        for key in keys:
+            if self.state and isinstance(key, str) and key in self.state:
+                del self.state[key]
+                changed, deleted = self._delta()
+                changed.pop(key, None)
+                deleted[key] = None
+
+    def _delta(self):
+        if self.delta is None:
+            self.delta = ({}, {})
+            tornado.ioloop.IOLoop.current().add_callback(self.flush_state)
+        return self.delta
+
+    # Sends the changes to every player, encoded once
+    def flush_state(self):
+        if self.delta is None:
+            return
+        changed, deleted = self.delta
+        self.delta = None
+        message = protocol.Encoded(messages.StateDelta(changed, list(deleted)))
+        for player in self.players.list():
+            player.write_encoded(message)
+        if self.spectators:
+            self.spectators.broadcast(message)
 
     # Check for a Player in PlayerPool, return None if not found
     def get_player_safe(self, player_name):
@@ -51,47 +100,60 @@ class Server(Client):
             return self.players[player_name]
 
     # Disconnect everyone and send a specific close code
-    def close_server(self):
-        logging.debug(f"Server {self.code} closes all connections")
+    def close_server(self, reason=exceptions.ServerClosing):
+        tracing.trace("room_closing", self.code, reason=reason.__name__)
 
         for player in self.players.list():
             try:
-                player.client.close(exceptions.ServerClosing())
+                player.client.close(reason())
             except:
-                logging.debug(
-                    f"Couldn't close connection with {player.name}, the user is likely away.")
+                logging.debug("Couldn't close connection with %s, the user is likely away.", player.name)
         try:
-            self.client.close(exceptions.ServerClosing())
+            self.client.close(reason())
         except:
-            logging.debug(
-                f"Couldn't close connection with server's owner, the user is likely away.")
+            logging.debug("Couldn't close connection with server's owner, the user is likely away.")
+        if self.spectators:
+            self.spectators.close(reason)
+
+
+def shard_of(code: str, shards: int) -> int:
+    """
+    Which worker owns a room code, when running with several workers.
+    """
+
+    return zlib.crc32(code.encode()) % shards
 
 
 class ServerPool:
     """
     Holder for Server classes.
+    With several workers, every pool only creates codes from its own shard.
     """
 
-    def __init__(self):
+    def __init__(self, shard=0, shards=1, code_length=4):
         self.pool = {}
+        self.shard = shard
+        self.shards = shards
+        self.codes = codes.CodeAllocator(code_length, self.owns)
+
+        # Codes used by other Beam nodes, see beam.bus
+        self.remote = {}
 
     def __contains__(self, what):
         return what in self.pool
 
-    def _gen_code(self, prefix: str):
-        x = "".join(random.choices(string.ascii_uppercase, k=4))
-        if not prefix+x in self:
-            return x
-        else:
-            return None
+    def owns(self, code: str):
+        return self.shards == 1 or shard_of(code, self.shards) == self.shard
 
-    def create_server(self, limit: int, prefix=""):
-        code = None
-        while not code:
-            code = self._gen_code(prefix)
+    # Raises codes.PoolExhausted when there's no code left
+    def create_server(self, limit: int, prefix="", **options):
+        code = self.codes.allocate(prefix, self.remote)
+        return self.add_server(code, limit, **options)
 
-        self.pool[prefix+code] = Server(prefix+code, limit)
-        return self.pool[prefix+code]
+    # For a code that's already allocated
+    def add_server(self, code: str, limit: int, **options):
+        self.pool[code] = Server(code, limit, **options)
+        return self.pool[code]
 
     def get_server_safe(self, server):
         if not server in self.pool:
@@ -105,3 +167,4 @@ class ServerPool:
                 f"ServerPool tried to free {server}, but this server is not present. Did an earlier check fail?")
         else:
             self.pool.pop(server)
+            self.codes.free(server)
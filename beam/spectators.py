@@ -0,0 +1,121 @@
+import struct
+
+import tornado.iostream
+
+from beam import protocol
+from beam.backpressure import FlowControl
+
+"""
+Read-only viewers of a room, for games streamed to a large audience.
+
+Spectators have no name, token or queue: they get the owner's broadcasts
+and the shared state (see Server.set_state) while they're connected, and
+nothing is kept for them when they're not. Their connections don't use
+compression, so every broadcast is turned into a WebSocket frame once
+and the same bytes are written to every spectator.
+
+A spectator that doesn't keep up misses frames instead of piling them up.
+Once it has caught up, it's told how many it missed and gets the whole
+shared state again before the next frame, deltas it missed included.
+"""
+
+_TEXT = 0x81
+_BINARY = 0x82
+
+
+def frame(payload: bytes, version: int) -> bytes:
+    """
+    An unmasked, unfragmented frame as a server sends it.
+    """
+
+    head = _BINARY if version == 1 else _TEXT
+    if len(payload) < 126:
+        header = struct.pack("!BB", head, len(payload))
+    elif len(payload) <= 0xFFFF:
+        header = struct.pack("!BBH", head, 126, len(payload))
+    else:
+        header = struct.pack("!BBQ", head, 127, len(payload))
+    return header + payload
+
+
+class Audience:
+    """
+    The spectators of a room, by protocol version.
+    Connections need a version and write_frame(frame, payload).
+    """
+
+    # Frames not written to spectators that fell behind, across every room
+    total_dropped = 0
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.members = tuple(set() for _ in protocol.VERSIONS)
+
+    def __len__(self):
+        return sum(len(members) for members in self.members)
+
+    def add(self, connection):
+        self.members[connection.version].add(connection)
+
+    def discard(self, connection):
+        self.members[connection.version].discard(connection)
+
+    def broadcast(self, encoded):
+        # Framed once per protocol version, whatever the number of spectators
+        for version, members in enumerate(self.members):
+            if members:
+                payload = encoded.get(version)
+                data = frame(payload, version)
+                for connection in members:
+                    if not connection.write_frame(data, payload):
+                        Audience.total_dropped += 1
+
+    def close(self, reason):
+        for members in self.members:
+            for connection in list(members):
+                connection.close(code=reason())
+
+
+class SpectatorStream:
+    """
+    Writes shared frames to the stream of one spectator's connection,
+    keeping at most max_buffered bytes in flight. After missing frames,
+    writing starts again once half of that is sent, with the frames
+    resync(missed) returns first.
+    """
+
+    __slots__ = ("stream", "max_buffered", "buffered", "resync", "missed")
+
+    def __init__(self, stream, max_buffered: int, resync):
+        self.stream = stream
+        self.max_buffered = max_buffered
+        self.buffered = 0
+        self.resync = resync
+        self.missed = 0
+
+    def write(self, data) -> bool:
+        if self.buffered >= (self.max_buffered // 2 if self.missed else self.max_buffered):
+            self.missed += 1
+            return False
+        if self.missed:
+            missed, self.missed = self.missed, 0
+            for frame in self.resync(missed):
+                self._write(frame)
+        self._write(data)
+        return True
+
+    def _write(self, data):
+        try:
+            future = self.stream.write(data)
+        except tornado.iostream.StreamClosedError:
+            # The connection is closing, it's gone from the audience soon
+            return
+
+        size = len(data)
+        self.buffered += size
+        FlowControl.total_buffered += size
+        future.add_done_callback(lambda f: self._written(size))
+
+    def _written(self, size):
+        self.buffered -= size
+        FlowControl.total_buffered -= size
@@ -0,0 +1,82 @@
+import logging
+import math
+import time
+
+import tornado.ioloop
+
+"""
+Coarse timers for things that happen rarely but are armed all the time,
+like closing rooms that stayed empty for too long.
+"""
+
+
+class TimerWheel:
+    """
+    A hashed timer wheel: one periodic callback for every timer.
+    Arming and disarming take constant time, timers fire on the first tick
+    after their deadline.
+    """
+
+    def __init__(self, callback, resolution=1.0, slots=512):
+        self.callback = callback
+        self.resolution = resolution
+        self.slots = [{} for _ in range(slots)]
+
+        # key -> index of its slot
+        self.where = {}
+
+        self.started = time.monotonic()
+        self.ticks = 0
+        self.ticker = None
+
+    def __len__(self):
+        return len(self.where)
+
+    def __contains__(self, key):
+        return key in self.where
+
+    def _now(self):
+        return int((time.monotonic() - self.started) / self.resolution)
+
+    def arm(self, key, timeout: float):
+        """
+        Calls back with key after timeout seconds, replacing its earlier timer.
+        """
+
+        self.disarm(key)
+        if not self.ticker:
+            # Nothing was armed, there are no ticks to catch up with
+            self.ticks = self._now()
+            self.ticker = tornado.ioloop.PeriodicCallback(self._tick, self.resolution * 1000)
+            self.ticker.start()
+
+        deadline = self.ticks + max(1, math.ceil(timeout / self.resolution))
+        slot = deadline % len(self.slots)
+        self.slots[slot][key] = deadline
+        self.where[key] = slot
+
+    def disarm(self, key):
+        slot = self.where.pop(key, None)
+        if slot is not None:
+            del self.slots[slot][key]
+
+    def _tick(self):
+        # Ticks the event loop was too busy for are made up here
+        now = self._now()
+        while self.ticks < now:
+            self.ticks += 1
+            slot = self.slots[self.ticks % len(self.slots)]
+            # Timers longer than a turn of the wheel stay for the next turns
+            expired = [key for key, deadline in slot.items() if deadline <= self.ticks]
+            for key in expired:
+                del slot[key]
+                del self.where[key]
+            for key in expired:
+                try:
+                    self.callback(key)
+                except Exception:
+                    logging.exception(f"Timer callback failed for {key}")
+
+        if not self.where:
+            self.ticker.stop()
+            self.ticker = None
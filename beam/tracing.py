@@ -0,0 +1,140 @@
+import collections
+import json
+import logging
+import random
+import time
+
+"""
+Structured events from Beam's hot paths, for debugging live rooms.
+
+Code that may emit an event often checks TRACER.active first, so nothing
+is built when nobody listens: that's the case unless a sink is enabled
+(a LogSink whose logger would print its level, a FileSink) or a room is
+watched. Events are sampled per name (TRACER.rates, 1.0 by default),
+events of watched rooms are always kept.
+
+Sinks:
+    LogSink  - through the logging module, formatted only when it's printed
+    FileSink - one JSON object per line
+    RingSink - the last events of watched rooms, shown by /inspect/<code>
+               to the admin_token holder
+"""
+
+
+class Event:
+    __slots__ = ("time", "name", "room", "fields")
+
+    def __init__(self, name, room, fields):
+        self.time = time.time()
+        self.name = name
+        self.room = room
+        self.fields = fields
+
+    def as_dict(self):
+        return dict(self.fields, time=self.time, event=self.name, room=self.room)
+
+    def __str__(self):
+        fields = " ".join(f"{key}={value}" for key, value in self.fields.items())
+        room = f" [{self.room}]" if self.room else ""
+        return f"{self.name}{room} {fields}".rstrip()
+
+
+class LogSink:
+    """
+    Passes events to a logger, at the given level.
+    """
+
+    def __init__(self, logger=None, level=logging.DEBUG):
+        self.logger = logger or logging.getLogger()
+        self.level = level
+
+    @property
+    def enabled(self):
+        return self.logger.isEnabledFor(self.level)
+
+    def write(self, event, watched):
+        if self.logger.isEnabledFor(self.level):
+            self.logger.log(self.level, "%s", event)
+
+
+class FileSink:
+    def __init__(self, path):
+        self.file = open(path, "a")
+        self.enabled = True
+
+    def write(self, event, watched):
+        self.file.write(json.dumps(event.as_dict(), default=str) + "\n")
+        self.file.flush()
+
+
+class RingSink:
+    """
+    Keeps the last size events of watched rooms, older ones are forgotten.
+    Doesn't make the tracer active by itself.
+    """
+
+    enabled = False
+
+    def __init__(self, size=1000):
+        self.events = collections.deque(maxlen=size)
+
+    def write(self, event, watched):
+        if watched:
+            self.events.append(event)
+
+    def room(self, code):
+        return [event.as_dict() for event in self.events if event.room == code]
+
+
+class Tracer:
+    def __init__(self):
+        self.sinks = []
+        # Event name -> fraction of them kept
+        self.rates = {}
+        self.watched = set()
+        # Whether a sink takes events of every room
+        self.everything = False
+        self.active = False
+
+    def configure(self, sinks, rates=None):
+        self.sinks = list(sinks)
+        self.rates = dict(rates or {})
+        self.refresh()
+
+    # Has to be called again after log levels change
+    def refresh(self):
+        self.everything = any(sink.enabled for sink in self.sinks)
+        self.active = self.everything or bool(self.watched)
+
+    def sink(self, kind):
+        return next((sink for sink in self.sinks if isinstance(sink, kind)), None)
+
+    # Records every event of a room, whatever the sampling
+    def watch(self, room):
+        self.watched.add(room)
+        self.refresh()
+
+    def unwatch(self, room):
+        self.watched.discard(room)
+        self.refresh()
+
+    # Positional only, so fields can be called name too
+    def trace(self, event, room=None, /, **fields):
+        if not self.active:
+            return
+        watched = room in self.watched
+        if not watched:
+            if not self.everything:
+                return
+            rate = self.rates.get(event, 1.0)
+            if rate < 1.0 and random.random() >= rate:
+                return
+
+        event = Event(event, room, fields)
+        for sink in self.sinks:
+            sink.write(event, watched)
+
+
+# Shared by everything in the process, set up by Beam
+TRACER = Tracer()
+trace = TRACER.trace
@@ -0,0 +1,169 @@
+import asyncio
+import itertools
+import json
+import logging
+import multiprocessing
+import socket
+import urllib.parse
+
+import tornado.httpserver
+import tornado.ioloop
+import tornado.iostream
+
+from beam.servers import shard_of
+
+"""
+Running Beam on several cores.
+
+Every worker process runs its own Beam instance and owns a slice of the room
+codes (see servers.shard_of). A front acceptor takes every connection, peeks
+at the request line to find the room code and passes the socket itself to
+the worker owning that room. Nothing goes through the acceptor afterwards.
+Only the request line is read, so requests about a room have to carry its
+code in the query string (or the path, for /inspect/<code>), not the body.
+
+Every worker keeps its own metrics: /metrics?worker=N scrapes worker N,
+/metrics alone always goes to worker 0. Scrape each worker as a target
+of its own, with the worker parameter turned into a label, e.g.
+
+    params: {worker: ["0"]}    # one target per worker
+    relabel_configs: [{source_labels: [__param_worker], target_label: worker}]
+"""
+
+PEEK_SIZE = 4096
+PEEK_TIMEOUT = 10
+
+
+def route(request_line: bytes, shards: int, fallback: int) -> int:
+    """
+    Picks the worker for a request line like b"GET /ws/v0?code=ABCD HTTP/1.1".
+    The code is read from the query string, or from the path of
+    /inspect/<code>. Requests without a code (creating rooms, the inspector's
+    list) go to `fallback`, except /metrics, which goes to the worker it asks for.
+    """
+
+    try:
+        target = request_line.split(b" ")[1].decode("latin-1")
+    except IndexError:
+        return fallback
+
+    url = urllib.parse.urlsplit(target)
+    query = urllib.parse.parse_qs(url.query)
+    code = query.get("code")
+    if code:
+        return shard_of(code[0], shards)
+    if url.path.startswith("/inspect/") and url.path[9:]:
+        return shard_of(url.path[9:].split("/")[0], shards)
+    if url.path == "/metrics":
+        worker = query.get("worker", ["0"])[0]
+        return int(worker) if worker.isdigit() and int(worker) < shards else 0
+    return fallback
+
+
+class Acceptor:
+    """
+    Accepts connections and hands them over to the workers.
+    """
+
+    def __init__(self, channels):
+        self.channels = channels
+        self.round_robin = itertools.cycle(range(len(channels)))
+        self.tasks = set()
+
+    async def serve(self, port: int, address=""):
+        loop = asyncio.get_running_loop()
+        listener = socket.create_server((address, port), backlog=1024)
+        listener.setblocking(False)
+
+        while True:
+            sock, peer = await loop.sock_accept(listener)
+            task = asyncio.create_task(self.hand_off(sock, peer))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def hand_off(self, sock, peer):
+        try:
+            line = await asyncio.wait_for(_peek_request_line(sock), PEEK_TIMEOUT)
+        except (asyncio.TimeoutError, OSError):
+            line = None
+
+        if line:
+            shard = route(line, len(self.channels), next(self.round_robin))
+            try:
+                socket.send_fds(self.channels[shard], [json.dumps(peer).encode()], [sock.fileno()])
+            except OSError:
+                logging.error(f"Couldn't hand a connection over to worker {shard}")
+        sock.close()
+
+
+async def _peek_request_line(sock):
+    # MSG_PEEK leaves the data in the socket for the worker to read
+    loop = asyncio.get_running_loop()
+    while True:
+        readable = loop.create_future()
+        loop.add_reader(sock.fileno(), lambda: readable.done() or readable.set_result(None))
+        try:
+            await readable
+        finally:
+            loop.remove_reader(sock.fileno())
+
+        data = sock.recv(PEEK_SIZE, socket.MSG_PEEK)
+        if not data:
+            return None
+        if b"\r\n" in data or len(data) == PEEK_SIZE:
+            return data.split(b"\r\n", 1)[0]
+        # Only part of the request line arrived so far
+        await asyncio.sleep(0.01)
+
+
+def _worker(make_app, shard, shards, channel, inherited):
+    # The acceptor's ends of the channels so far came with the fork,
+    # holding them would keep those workers running after the acceptor is gone
+    for other in inherited:
+        other.close()
+
+    app = make_app(shard, shards)
+    server = tornado.httpserver.HTTPServer(app)
+    ioloop = tornado.ioloop.IOLoop.current()
+
+    def receive(fd, events):
+        try:
+            message, fds, _, _ = socket.recv_fds(channel, 1024, 1)
+        except BlockingIOError:
+            return
+        if not message:
+            # The acceptor is gone
+            ioloop.stop()
+            return
+
+        peer = tuple(json.loads(message))
+        for fd in fds:
+            sock = socket.socket(fileno=fd)
+            sock.setblocking(False)
+            server.handle_stream(tornado.iostream.IOStream(sock), peer)
+
+    channel.setblocking(False)
+    ioloop.add_handler(channel.fileno(), receive, ioloop.READ)
+    logging.info(f"Worker {shard} started")
+    ioloop.start()
+
+
+def run(make_app, port: int, workers: int, address=""):
+    """
+    Starts `workers` Beam processes behind an acceptor listening on `port`.
+    make_app(shard, shards) builds the Beam instance of every worker.
+    """
+
+    context = multiprocessing.get_context("fork")
+    channels = []
+    for shard in range(workers):
+        parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        context.Process(
+            target=_worker,
+            args=(make_app, shard, workers, child, channels + [parent]),
+            daemon=True
+        ).start()
+        child.close()
+        channels.append(parent)
+
+    asyncio.run(Acceptor(channels).serve(port, address))
@@ -0,0 +1,59 @@
+"""
+Microbenchmark for the `to: 2` broadcast path.
+
+Compares encoding the message once per recipient (what
+Client.write_message does) with the shared payload used by
+Client.sends_message. Run it from the repository root:
+
+    python -m benchmarks.broadcast
+"""
+
+import timeit
+
+from beam import messages
+from beam.players import Player
+from beam.servers import Server
+
+
+class NullConnection:
+    """
+    Stands in for a BeamWebsocket, swallows everything written to it.
+    """
+
+    def write_message(self, message, binary=False):
+        pass
+
+
+def make_room(size):
+    server = Server("BENCH", -1)
+    server.client = NullConnection()
+    for i in range(size):
+        server.players[f"player{i}"] = Player(f"player{i}", NullConnection())
+    return server
+
+
+def main():
+    content = {"board": [[0] * 8 for _ in range(8)], "turn": "player0", "move": 42}
+    print(f"{'players':>8} {'per-recipient (us)':>20} {'shared (us)':>14}")
+
+    for size in (1, 10, 100, 1000):
+        server = make_room(size)
+        sender = server.players["player0"]
+        message = messages.Message(sender, content)
+        targets = server.players.list() + [server]
+
+        def per_recipient():
+            for recipient in targets:
+                recipient.write_message(message)
+
+        def shared():
+            sender.sends_message(targets, message)
+
+        number = max(1, 20000 // size)
+        old = min(timeit.repeat(per_recipient, number=number, repeat=5)) / number
+        new = min(timeit.repeat(shared, number=number, repeat=5)) / number
+        print(f"{size:>8} {old * 1e6:>20.1f} {new * 1e6:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
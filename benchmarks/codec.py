@@ -0,0 +1,128 @@
+"""
+Compares the JSON codecs of beam.codec on the shapes of Beam's messages,
+and checks they agree: both encodings of every message must decode to the
+same value, and both decoders must read incoming packets the same way.
+Run it from the repository root:
+
+    python -m benchmarks.codec
+    python -m benchmarks.codec --check    # only the conformance check
+
+Exits with status 1 when the codecs disagree.
+"""
+
+import argparse
+import json
+import sys
+import timeit
+
+from beam import codec, messages
+from beam.players import Player, PlayerPool
+
+
+def make_players(count):
+    pool = PlayerPool()
+    for i in range(count):
+        pool[f"player{i}"] = Player(f"player{i}", None)
+    return pool
+
+
+def outgoing(pool):
+    sender = pool["player3"]
+    move = {"x": 3, "y": 7, "piece": "knight"}
+    board = {"board": [[0] * 8 for _ in range(8)], "turn": 12, "scores": {"a": 1.5, "b": -2}}
+    return {
+        "token": messages.Token("7f8c2b8e-9d3e-4c55-a1c4-0d5e1b2f3a4c"),
+        "joined": messages.UserJoin(sender),
+        "users": messages.UsersList(pool.list()),
+        "msg": messages.Message(sender, move),
+        "msg, board": messages.Message(sender, board),
+        "batch of 10": messages.Batch([messages.Message(sender, move)] * 10),
+        "delta": messages.StateDelta({"turn": "player4", "board": board["board"]}, ["timer"]),
+    }
+
+
+def incoming():
+    move = {"x": 3, "y": 7, "piece": "knight"}
+    return {
+        "msg": json.dumps({"to": "player1", "content": move}),
+        "msg, board": json.dumps({"to": 2, "content": {"board": [[0] * 8 for _ in range(8)], "turn": 12}}),
+        "batch of 10": json.dumps([{"to": 1, "content": move}] * 10),
+    }
+
+
+# Values the fast path may not handle itself, they have to come out the same anyway
+EDGE_CASES = [
+    {"text": "żluťoučký kůň ☃ \U0001F600", "escaped": "\"quotes\" \\ \n\t"},
+    {"big": 2 ** 70, "negative": -2 ** 65, "float": 0.1, "exponent": 1e300},
+    {"nested": [[[[{"a": None, "b": True, "c": False}]]]]},
+    {"data": b"raw bytes from a v1 client", "view": memoryview(b"a view")},
+    messages.Message(Player("pé", None), {"list": [], "dict": {}}),
+]
+
+
+def std_value(data):
+    return json.loads(data)
+
+
+def conformance(pool):
+    """
+    Differences between the stdlib codec and the active one, as text lines.
+    """
+
+    problems = []
+    values = list(outgoing(pool).items()) + [(f"edge case {i}", v) for i, v in enumerate(EDGE_CASES)]
+    for name, value in values:
+        if std_value(codec.std_dumps(value)) != std_value(codec.dumps(value)):
+            problems.append(f"encoding {name}: {codec.std_dumps(value)!r} != {codec.dumps(value)!r}")
+
+    packets = list(incoming().values()) + [json.dumps(v, default=codec._default) for v in EDGE_CASES]
+    for packet in packets:
+        for data in (packet, packet.encode(), memoryview(packet.encode())):
+            if codec.std_loads(data) != codec.loads(data):
+                problems.append(f"decoding {packet[:40]!r} as {type(data).__name__}")
+
+    for invalid in ("{", "[1,]", "nope"):
+        try:
+            codec.loads(invalid)
+            problems.append(f"decoding {invalid!r} didn't fail")
+        except ValueError:
+            pass
+    return problems
+
+
+def measure(function, number=20000):
+    return min(timeit.repeat(function, number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Beam JSON codecs")
+    parser.add_argument("--check", action="store_true", help="only check that the codecs agree")
+    args = parser.parse_args()
+
+    pool = make_players(8)
+    problems = conformance(pool)
+    for problem in problems:
+        print(problem)
+    print(f"{codec.NAME}: {'conforms' if not problems else 'DOES NOT conform'} to the json module")
+
+    if not args.check:
+        print()
+        print(f"{'encoding':<14} {'bytes':>6} {'json us':>8} {codec.NAME + ' us':>10}")
+        for name, value in outgoing(pool).items():
+            size = len(codec.dumps(value))
+            std = measure(lambda: codec.std_dumps(value))
+            fast = measure(lambda: codec.dumps(value))
+            print(f"{name:<14} {size:>6} {std:>8.2f} {fast:>10.2f}")
+
+        print(f"{'decoding':<14} {'bytes':>6} {'json us':>8} {codec.NAME + ' us':>10}")
+        for name, packet in incoming().items():
+            std = measure(lambda: codec.std_loads(packet))
+            fast = measure(lambda: codec.loads(packet))
+            print(f"{name:<14} {len(packet):>6} {std:>8.2f} {fast:>10.2f}")
+
+    if problems:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
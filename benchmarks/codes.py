@@ -0,0 +1,62 @@
+"""
+Room code allocation at high occupancy.
+
+Compares drawing random codes until one is free (the old
+ServerPool._gen_code loop) with beam.codes.CodeAllocator,
+on 3 letter codes so the space fills up quickly:
+
+    python -m benchmarks.codes
+"""
+
+import random
+import string
+import time
+
+from beam.codes import CodeAllocator, PoolExhausted
+
+LENGTH = 3
+SIZE = 26 ** LENGTH
+
+
+def retry_draw(used):
+    while True:
+        code = "".join(random.choices(string.ascii_uppercase, k=LENGTH))
+        if code not in used:
+            return code
+
+
+def main():
+    print(f"{SIZE} codes")
+    print(f"{'occupancy':>10} {'retry (us)':>11} {'allocator (us)':>15}")
+
+    for occupancy in (0.5, 0.9, 0.99, 0.999):
+        allocator = CodeAllocator(LENGTH)
+        used = set()
+        for _ in range(int(SIZE * occupancy)):
+            used.add(allocator.allocate())
+
+        # Allocate and free again, so the occupancy stays the same
+        rounds = 2000
+        start = time.perf_counter()
+        for _ in range(rounds):
+            code = retry_draw(used)
+        old = (time.perf_counter() - start) / rounds
+
+        start = time.perf_counter()
+        for _ in range(rounds):
+            allocator.free(allocator.allocate())
+        new = (time.perf_counter() - start) / rounds
+
+        print(f"{occupancy:>10.1%} {old * 1e6:>11.1f} {new * 1e6:>15.1f}")
+
+    allocator = CodeAllocator(LENGTH)
+    for _ in range(SIZE):
+        allocator.allocate()
+    try:
+        allocator.allocate()
+    except PoolExhausted as e:
+        print(f"{'100%':>10} {'never ends':>11} {'PoolExhausted':>15}  ({e})")
+
+
+if __name__ == "__main__":
+    main()
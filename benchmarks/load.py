@@ -0,0 +1,472 @@
+"""
+Load generator for Beam, by default against a server in the same process.
+
+Drives scripted scenarios over real HTTP and WebSocket connections on
+localhost and reports latency percentiles, throughput, CPU time and memory.
+Clients run in the same process and on the same event loop as the server,
+so CPU time covers both sides.
+
+    python -m benchmarks.load                    # run everything, compare with the baselines
+    python -m benchmarks.load broadcast joins    # only some scenarios
+    python -m benchmarks.load --save             # store the results as the new baselines
+    python -m benchmarks.load --scale 0.2        # smaller runs
+
+Exits with status 1 when a scenario is slower than its baseline by more than
+--tolerance. Baselines depend on the machine, save your own before
+comparing changes.
+
+--url runs the scenarios against a Beam server started separately, like
+server.py with BEAM_WORKERS=N (migration needs the server in-process).
+CPU time and memory are then the load generator's own. --processes splits
+the load over several client processes, so they don't become the
+bottleneck. Neither is compared with the baselines. To see how workers
+scale, run the same command against 1, 2, 4... workers, with limits and
+load shedding out of the way:
+
+    MAX_SERVERS=1000000 MAX_USERS=1000000 MAX_CREATED=1000000 BEAM_MAX_LOOP_LAG=10 \
+        BEAM_WORKERS=4 python server.py
+    python -m benchmarks.load --url http://127.0.0.1:8000 --processes 4 parallel
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+import tornado.httpclient
+import tornado.websocket
+
+from beam import Beam, handoff
+
+BASELINES = os.path.join(os.path.dirname(__file__), "baselines.json")
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def rss_mib():
+    # Current resident memory, ru_maxrss would only give the peak
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 2 ** 20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Harness:
+    def __init__(self, url=None):
+        self.app = self.server = None
+        if url:
+            self.base = url.split("://")[-1].rstrip("/")
+        else:
+            self.start()
+        self.http = tornado.httpclient.AsyncHTTPClient(max_clients=64)
+
+    def start(self):
+        # Limits are for abuse, not for a benchmark hammering from localhost
+        self.app = Beam(
+            do_inspect=False,
+            max_servers=10 ** 9,
+            max_users=10 ** 9,
+            max_created=10 ** 9
+        )
+        self.server = self.app.listen(0, address="127.0.0.1")
+        port = list(self.server._sockets.values())[0].getsockname()[1]
+        self.base = f"127.0.0.1:{port}"
+
+    async def create_room(self, **arguments):
+        query = "&".join(f"{k}={v}" for k, v in arguments.items())
+        response = await self.http.fetch(f"http://{self.base}/beam/v0/server?{query}", method="POST", body="")
+        return json.loads(response.body)
+
+    async def delete_room(self, room):
+        await self.http.fetch(
+            f"http://{self.base}/beam/v0/server?code={room['code']}&token={room['token']}",
+            method="DELETE")
+
+    async def connect(self, room, **arguments):
+        query = "&".join(f"{k}={v}" for k, v in dict(code=room["code"], **arguments).items())
+        return await tornado.websocket.websocket_connect(f"ws://{self.base}/ws/v0?{query}")
+
+    async def join(self, room, name, **arguments):
+        # Returns the connection and the player's token
+        ws = await self.connect(room, name=name, **arguments)
+        token = json.loads(await ws.read_message())["token"]
+        return ws, token
+
+    async def read_until(self, ws, kind, **fields):
+        while True:
+            message = json.loads(await ws.read_message())
+            if message["type"] == kind and all(message.get(k) == v for k, v in fields.items()):
+                return message
+
+    def close(self):
+        if self.server:
+            self.server.stop()
+
+
+# Scenarios return a list of latencies (one per operation, in seconds),
+# the duration of the measured part and how many messages were delivered in it
+
+async def rooms(h, scale):
+    """POST /beam/v0/server, one room after another."""
+    latencies, created = [], []
+    begin = time.perf_counter()
+    for _ in range(int(500 * scale)):
+        start = time.perf_counter()
+        created.append(await h.create_room())
+        latencies.append(time.perf_counter() - start)
+    elapsed = time.perf_counter() - begin
+    for room in created:
+        await h.delete_room(room)
+    return latencies, elapsed, len(created)
+
+
+async def joins(h, scale):
+    """Many players registering in one room at the same time."""
+    room = await h.create_room()
+    owner = await h.connect(room, token=room["token"])
+
+    async def one(i):
+        start = time.perf_counter()
+        ws, _ = await h.join(room, f"p{i}")
+        latency = time.perf_counter() - start
+        return ws, latency
+
+    begin = time.perf_counter()
+    results = await asyncio.gather(*(one(i) for i in range(int(200 * scale))))
+    elapsed = time.perf_counter() - begin
+    for ws, _ in results:
+        ws.close()
+    owner.close()
+    await h.delete_room(room)
+    # Tokens, plus a join notice for the owner
+    return [latency for _, latency in results], elapsed, len(results) * 2
+
+
+async def broadcast(h, scale):
+    """The owner sending to everyone, until the last player has the message."""
+    room = await h.create_room()
+    owner = await h.connect(room, token=room["token"])
+    players = [(await h.join(room, f"p{i}"))[0] for i in range(50)]
+
+    latencies = []
+    begin = time.perf_counter()
+    for i in range(int(400 * scale)):
+        start = time.perf_counter()
+        owner.write_message("!" + json.dumps({"to": 2, "content": {"n": i}}))
+        for ws in players:
+            await h.read_until(ws, "msg")
+        latencies.append(time.perf_counter() - start)
+    elapsed = time.perf_counter() - begin
+
+    for ws in players:
+        ws.close()
+    owner.close()
+    await h.delete_room(room)
+    # The owner gets its own broadcast too
+    return latencies, elapsed, len(latencies) * (len(players) + 1)
+
+
+async def batches(h, scale):
+    """Command 34 with 20 parts, until the owner has received them all."""
+    room = await h.create_room()
+    owner = await h.connect(room, token=room["token"], protocol=1)
+    player, _ = await h.join(room, "sender")
+    await h.read_until(owner, "joined")
+    parts = [{"to": 1, "content": {"part": i}} for i in range(20)]
+
+    latencies = []
+    begin = time.perf_counter()
+    for _ in range(int(500 * scale)):
+        start = time.perf_counter()
+        player.write_message('"' + json.dumps(parts))
+        await h.read_until(owner, "batch")
+        latencies.append(time.perf_counter() - start)
+    elapsed = time.perf_counter() - begin
+
+    player.close()
+    owner.close()
+    await h.delete_room(room)
+    return latencies, elapsed, len(latencies) * len(parts)
+
+
+async def bursts(h, scale):
+    """Bursts of 20 small messages to everyone in a room that coalesces them."""
+    room = await h.create_room(coalesce_ms=5)
+    owner = await h.connect(room, token=room["token"])
+    players = []
+    for i in range(20):
+        ws, _ = await h.join(room, f"p{i}", protocol=1)
+        players.append(ws)
+
+    async def last(ws, n):
+        # Until the last message of the burst, alone or in a batch
+        while True:
+            message = json.loads(await ws.read_message())
+            if n in [m["data"] for m in message.get("list", [message]) if m["type"] == "msg"]:
+                return
+
+    latencies = []
+    begin = time.perf_counter()
+    for burst in range(int(100 * scale)):
+        start = time.perf_counter()
+        for i in range(20):
+            owner.write_message("!" + json.dumps({"to": 2, "content": burst * 20 + i}))
+        for ws in players:
+            await last(ws, burst * 20 + 19)
+        latencies.append(time.perf_counter() - start)
+    elapsed = time.perf_counter() - begin
+
+    for ws in players:
+        ws.close()
+    owner.close()
+    await h.delete_room(room)
+    return latencies, elapsed, len(latencies) * 20 * len(players)
+
+
+async def parallel(h, scale):
+    """Many rooms at once, every owner broadcasting to its players."""
+    async def room_load():
+        room = await h.create_room()
+        owner = await h.connect(room, token=room["token"])
+        players = [(await h.join(room, f"p{i}"))[0] for i in range(8)]
+
+        latencies = []
+        for i in range(int(100 * scale)):
+            start = time.perf_counter()
+            owner.write_message("!" + json.dumps({"to": 2, "content": {"n": i}}))
+            for ws in players:
+                await h.read_until(ws, "msg")
+            latencies.append(time.perf_counter() - start)
+
+        for ws in players:
+            ws.close()
+        owner.close()
+        await h.delete_room(room)
+        return latencies, len(latencies) * (len(players) + 1)
+
+    begin = time.perf_counter()
+    results = await asyncio.gather(*(room_load() for _ in range(16)))
+    elapsed = time.perf_counter() - begin
+    return [l for latencies, _ in results for l in latencies], elapsed, sum(d for _, d in results)
+
+
+async def spectators(h, scale):
+    """The owner broadcasting to a large audience, until every spectator has the message."""
+    room = await h.create_room()
+    owner = await h.connect(room, token=room["token"])
+    audience = [await h.connect(room, spectate=1) for _ in range(int(1000 * scale))]
+
+    latencies = []
+    begin = time.perf_counter()
+    for i in range(20):
+        start = time.perf_counter()
+        owner.write_message("!" + json.dumps({"to": 2, "content": {"n": i}}))
+        for ws in audience:
+            await h.read_until(ws, "msg")
+        latencies.append(time.perf_counter() - start)
+    elapsed = time.perf_counter() - begin
+
+    for ws in audience:
+        ws.close()
+    owner.close()
+    await h.delete_room(room)
+    return latencies, elapsed, len(latencies) * len(audience)
+
+
+async def reconnects(h, scale):
+    """Players dropping and logging back in, until the owner sees them connected."""
+    room = await h.create_room()
+    owner = await h.connect(room, token=room["token"])
+    players = [await h.join(room, f"p{i}") for i in range(int(100 * scale))]
+
+    async def one(i, ws, token):
+        ws.close()
+        start = time.perf_counter()
+        ws = await h.connect(room, name=f"p{i}", token=token)
+        return ws, start
+
+    begin = time.perf_counter()
+    results = await asyncio.gather(*(one(i, ws, token) for i, (ws, token) in enumerate(players)))
+    starts = {f"p{i}": start for i, (_, start) in enumerate(results)}
+    latencies = []
+    while starts:
+        message = json.loads(await owner.read_message())
+        if message["type"] == "connected" and message["name"] in starts:
+            latencies.append(time.perf_counter() - starts.pop(message["name"]))
+    elapsed = time.perf_counter() - begin
+
+    for ws, _ in results:
+        ws.close()
+    owner.close()
+    await h.delete_room(room)
+    return latencies, elapsed, len(latencies)
+
+
+async def migration(h, scale):
+    """Rooms handed over to a new process, until every client is back on it."""
+    rooms, clients = [], []
+    for _ in range(int(20 * scale)):
+        room = await h.create_room()
+        rooms.append(room)
+        clients.append((room, None, await h.connect(room, token=room["token"]), None))
+        for i in range(5):
+            ws, token = await h.join(room, f"p{i}")
+            clients.append((room, f"p{i}", ws, token))
+
+    path = os.path.join(tempfile.mkdtemp(), "handoff")
+    old_app, old_server = h.app, h.server
+    await handoff.HandoffServer(old_app, path, old_server.stop).start()
+    # The new process, clients reconnect to its address
+    h.start()
+
+    begin = time.perf_counter()
+    await handoff.take_over(h.app, path)
+
+    async def one(room, name, ws, token):
+        # Until the old process closes the connection
+        while await ws.read_message() is not None:
+            pass
+        arguments = {"name": name, "token": token} if name else {"token": room["token"]}
+        await h.connect(room, **arguments)
+        return time.perf_counter() - begin
+
+    latencies = await asyncio.gather(*(one(*client) for client in clients))
+    elapsed = time.perf_counter() - begin
+    for room in rooms:
+        await h.delete_room(room)
+    return latencies, elapsed, len(latencies)
+
+
+SCENARIOS = {
+    "rooms": rooms,
+    "joins": joins,
+    "broadcast": broadcast,
+    "batches": batches,
+    "bursts": bursts,
+    "parallel": parallel,
+    "spectators": spectators,
+    "reconnects": reconnects,
+    "migration": migration
+}
+
+
+async def measure(names, scale, url=None):
+    # Raw measurements of every scenario: latencies, elapsed, delivered, cpu, rss
+    h = Harness(url)
+    measured = {}
+    try:
+        for name in names:
+            cpu = time.process_time()
+            latencies, elapsed, delivered = await SCENARIOS[name](h, scale)
+            measured[name] = (latencies, elapsed, delivered, time.process_time() - cpu, rss_mib())
+            # Let closing connections settle before the next scenario
+            await asyncio.sleep(0.2)
+    finally:
+        h.close()
+    return measured
+
+
+def _measure_process(arguments):
+    return asyncio.run(measure(*arguments))
+
+
+def run(names, scale, url=None, processes=1):
+    if processes > 1:
+        with multiprocessing.get_context("fork").Pool(processes) as pool:
+            measured = pool.map(_measure_process, [(names, scale, url)] * processes)
+    else:
+        measured = [asyncio.run(measure(names, scale, url))]
+
+    # Client processes run side by side, their throughputs add up
+    results = {}
+    for name in names:
+        parts = [m[name] for m in measured]
+        latencies = [l for part in parts for l in part[0]]
+        results[name] = {
+            "scale": scale,
+            "operations": len(latencies),
+            "p50_ms": percentile(latencies, 0.5) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "msgs_per_s": sum(part[2] / part[1] for part in parts),
+            "cpu_s": sum(part[3] for part in parts),
+            "rss_mib": sum(part[4] for part in parts)
+        }
+    return results
+
+
+def compare(results, baselines, tolerance):
+    """
+    Regressions against the stored baselines, as text lines.
+    """
+
+    regressions = []
+    for name, result in results.items():
+        baseline = baselines.get(name)
+        # Latencies of concurrent scenarios grow with their size
+        if not baseline or baseline["scale"] != result["scale"]:
+            continue
+        if result["p50_ms"] > baseline["p50_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p50 {result['p50_ms']:.2f} ms, baseline {baseline['p50_ms']:.2f} ms")
+        if result["msgs_per_s"] < baseline["msgs_per_s"] / (1 + tolerance):
+            regressions.append(f"{name}: {result['msgs_per_s']:.0f} msgs/s, baseline {baseline['msgs_per_s']:.0f} msgs/s")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Beam load generator")
+    parser.add_argument("scenarios", nargs="*", help=", ".join(SCENARIOS))
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplier for the number of operations")
+    parser.add_argument("--save", action="store_true", help="store the results as baselines")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="allowed slowdown, 0.5 is 50%%")
+    parser.add_argument("--url", help="a Beam server to load instead of an in-process one")
+    parser.add_argument("--processes", type=int, default=1, help="client processes generating the load")
+    args = parser.parse_args()
+
+    names = args.scenarios or [name for name in SCENARIOS if not (args.url and name == "migration")]
+    for name in names:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario: {name}")
+    if args.url and "migration" in names:
+        parser.error("migration needs the server in-process, it can't run with --url")
+    results = run(names, args.scale, args.url, args.processes)
+
+    print(f"{'scenario':>11} {'ops':>6} {'p50 ms':>8} {'p99 ms':>8} {'msgs/s':>9} {'cpu s':>7} {'rss MiB':>8}")
+    for name, r in results.items():
+        print(f"{name:>11} {r['operations']:>6} {r['p50_ms']:>8.2f} {r['p99_ms']:>8.2f} "
+              f"{r['msgs_per_s']:>9.0f} {r['cpu_s']:>7.2f} {r['rss_mib']:>8.1f}")
+
+    if args.url or args.processes > 1:
+        # Baselines are for the in-process server and a single client process
+        return
+
+    baselines = {}
+    if os.path.exists(BASELINES):
+        with open(BASELINES) as f:
+            baselines = json.load(f)
+
+    if args.save:
+        baselines.update(results)
+        with open(BASELINES, "w") as f:
+            json.dump(baselines, f, indent=4, sort_keys=True)
+            f.write("\n")
+        print(f"Saved baselines to {BASELINES}")
+        return
+
+    regressions = compare(results, baselines, args.tolerance)
+    for line in regressions:
+        print("REGRESSION", line)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""
+Memory used by idle rooms, connected players and the history of a room
+with sequenced players, checked against a budget.
+
+Beam's own objects are measured with tracemalloc, Tornado's per-socket
+state (streams, buffers, deflate contexts) separately over real loopback
+connections. Run it from the repository root:
+
+    python -m benchmarks.memory
+    python -m benchmarks.memory --sockets 0    # skip the real connections
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import resource
+import sys
+import tracemalloc
+
+from beam import Beam, messages, protocol
+from beam.players import Player
+
+# Bytes of Beam state, so 100k players fit in about 50 MB next to Tornado's own
+ROOM_BUDGET = 1024
+PLAYER_BUDGET = 512
+# History of a sequenced room full of broadcasts, per player
+HISTORY_BUDGET = 256
+
+
+class IdleConnection:
+    """
+    Stands in for a BeamWebsocket that is connected and keeping up.
+    """
+
+    version = 0
+    protocol = 0
+
+    def write_message(self, message, binary=False):
+        pass
+
+
+class SequencedConnection(IdleConnection):
+    protocol = messages.SEQ_PROTOCOL
+
+
+def measure(build, count):
+    gc.collect()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    kept = [build(i) for i in range(count)]
+    gc.collect()
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    return (after - before) / count
+
+
+def rooms(app, count):
+    def build(i):
+        server = app.pool.create_server(-1, "R", **app.room_options())
+        server.client = IdleConnection()
+        return server
+    return measure(build, count)
+
+
+def players(app, count):
+    server = app.pool.create_server(-1, "P", **app.room_options())
+    connection = IdleConnection()
+
+    def build(i):
+        player = Player(f"player{i}", connection, history=server.history, **app.client_options())
+        server.players[player.name] = player
+        return player
+    return measure(build, count)
+
+
+def history(app, count):
+    server = app.pool.create_server(-1, "H", **app.room_options())
+    connection = SequencedConnection()
+    room = [Player(f"player{i}", connection, history=server.history, **app.client_options())
+            for i in range(count)]
+
+    # Only what the history adds, the messages are there either way
+    broadcasts = [protocol.Encoded(messages.Message(server, {"tick": i})) for i in range(app.HISTORY_SIZE)]
+    for encoded in broadcasts:
+        encoded.get(0)
+
+    gc.collect()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    for encoded in broadcasts:
+        for player in room:
+            player.write_encoded(encoded)
+    gc.collect()
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (after - before) / count
+
+
+def rss():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+async def sockets(count):
+    import tornado.httpclient
+    import tornado.websocket
+
+    app = Beam(do_inspect=False, max_users=10 ** 9)
+    listener = app.listen(0, address="127.0.0.1")
+    port = list(listener._sockets.values())[0].getsockname()[1]
+    http = tornado.httpclient.AsyncHTTPClient()
+    room = json.loads((await http.fetch(
+        f"http://127.0.0.1:{port}/beam/v0/server", method="POST", body="")).body)
+
+    gc.collect()
+    before = rss()
+    connections = []
+    for i in range(count):
+        ws = await tornado.websocket.websocket_connect(
+            f"ws://127.0.0.1:{port}/ws/v0?code={room['code']}&name=p{i}")
+        await ws.read_message()
+        connections.append(ws)
+    gc.collect()
+    per_socket = (rss() - before) / count
+
+    for ws in connections:
+        ws.close()
+    listener.stop()
+    return per_socket
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Beam memory budget")
+    parser.add_argument("--count", type=int, default=20000, help="rooms and players to create")
+    parser.add_argument("--sockets", type=int, default=500, help="real connections to open")
+    parser.add_argument("--sequenced", type=int, default=1000, help="players of the sequenced room")
+    args = parser.parse_args()
+
+    app = Beam(do_inspect=False)
+    room = rooms(app, args.count)
+    player = players(app, args.count)
+    sequenced = history(app, args.sequenced)
+
+    print(f"idle room:        {room:>8.0f} bytes  (budget {ROOM_BUDGET})")
+    print(f"connected player: {player:>8.0f} bytes  (budget {PLAYER_BUDGET})")
+    print(f"100k players:     {player * 100000 / 2 ** 20:>8.1f} MiB of Beam state")
+    print(f"room history:     {sequenced:>8.0f} bytes per player  (budget {HISTORY_BUDGET}, "
+          f"{app.HISTORY_SIZE} broadcasts to {args.sequenced} sequenced players)")
+
+    if args.sockets:
+        per_socket = asyncio.run(sockets(args.sockets))
+        # Both ends of every connection live in this process
+        print(f"real connection:  {per_socket:>8.0f} bytes of RSS, client side included")
+        print(f"100k sockets:     {(player + per_socket) * 100000 / 2 ** 20:>8.1f} MiB at most")
+
+    if room > ROOM_BUDGET or player > PLAYER_BUDGET or sequenced > HISTORY_BUDGET:
+        print("Over budget")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Compares the v0 (JSON) and v1 (binary) protocols:
+bytes on the wire and CPU time per message, for outgoing and incoming frames.
+Also compares a full v0 hop (decode, re-encode) with and without relay mode.
+Run it from the repository root:
+
+    python -m benchmarks.protocol
+"""
+
+import json
+import struct
+import timeit
+
+from beam import messages, protocol
+from beam.players import Player, PlayerPool
+
+
+def make_players(count):
+    pool = PlayerPool()
+    for i in range(count):
+        pool[f"player{i}"] = Player(f"player{i}", None)
+    return pool
+
+
+def outgoing(pool):
+    sender = pool["player3"]
+    move = {"x": 3, "y": 7, "piece": "knight"}
+    return {
+        "msg": (messages.Message(sender, move), messages.Message(sender, json.dumps(move).encode())),
+        "joined": (messages.UserJoin(sender),) * 2,
+        "users": (messages.UsersList(pool.list()),) * 2,
+        "batch of 10": (
+            messages.Batch([messages.Message(sender, move)] * 10),
+            messages.Batch([messages.Message(sender, json.dumps(move).encode())] * 10)
+        ),
+    }
+
+
+def incoming():
+    move = json.dumps({"x": 3, "y": 7, "piece": "knight"})
+    v0 = "!" + json.dumps({"to": "player1", "content": json.loads(move)})
+    v1 = bytes((33, protocol.TO_INDEX)) + struct.pack("!I", 1) + move.encode()
+    return v0, v1
+
+
+def measure(function, number=20000):
+    return min(timeit.repeat(function, number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    pool = make_players(8)
+
+    print(f"{'outgoing':<14} {'v0 bytes':>9} {'v1 bytes':>9} {'v0 us':>8} {'v1 us':>8}")
+    for name, (v0, v1) in outgoing(pool).items():
+        size0 = len(protocol.encode(v0, 0))
+        size1 = len(protocol.encode(v1, 1))
+        time0 = measure(lambda: protocol.encode(v0, 0))
+        time1 = measure(lambda: protocol.encode(v1, 1))
+        print(f"{name:<14} {size0:>9} {size1:>9} {time0:>8.2f} {time1:>8.2f}")
+
+    v0, v1 = incoming()
+    time0 = measure(lambda: (ord(v0[0]), json.loads(v0[1:])))
+    time1 = measure(lambda: protocol.decode_v1(v1))
+    print(f"{'incoming msg':<14} {len(v0.encode()):>9} {len(v1):>9} {time0:>8.2f} {time1:>8.2f}")
+
+    sender = pool["player3"]
+    content = json.dumps({"board": [[0] * 8 for _ in range(8)], "turn": 12})
+    parsed = "!" + json.dumps({"to": 2, "content": json.loads(content)})
+    relayed = "'2\n" + content
+
+    def hop(message):
+        data = json.loads(message[1:])
+        protocol.encode(messages.Message(sender, data["content"]), 0)
+
+    def relay_hop(message):
+        data = protocol.decode_relay(message)
+        protocol.encode(messages.Message(sender, data["content"]), 0)
+
+    print()
+    print(f"v0 hop, parsed: {measure(lambda: hop(parsed)):.2f} us, relay mode: {measure(lambda: relay_hop(relayed)):.2f} us")
+
+
+if __name__ == "__main__":
+    main()
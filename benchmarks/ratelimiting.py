@@ -0,0 +1,48 @@
+"""
+Microbenchmark for the rate limiter's check path, and its memory under
+a flood of joins from many addresses. Run it from the repository root:
+
+    python -m benchmarks.ratelimiting
+"""
+
+import timeit
+import tracemalloc
+
+from beam.ratelimiting import RateLimiter
+
+
+def make_limiter(max_entries=65536):
+    limiter = RateLimiter(max_entries)
+    limiter.scope("join", 3, 1, 200)
+    return limiter
+
+
+def main():
+    limiter = make_limiter()
+    # A huge rate, so the same IP is never refused
+    limiter.scope("fast", 10 ** 9, 1)
+    number = 200000
+
+    t = min(timeit.repeat(lambda: limiter.allow("10.0.0.1", "fast"), number=number, repeat=5)) / number
+    print(f"known IP:        {t * 1e9:>6.0f} ns per check")
+
+    ips = [f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}" for i in range(number)]
+    it = iter(ips * 5)
+    t = min(timeit.repeat(lambda: limiter.allow(next(it), "join"), number=number, repeat=5)) / number
+    print(f"new IP, evicting:{t * 1e9:>6.0f} ns per check")
+
+    t = min(timeit.repeat(lambda: limiter.allow("10.0.0.2", "join"), number=number, repeat=5)) / number
+    print(f"banned IP:       {t * 1e9:>6.0f} ns per check")
+
+    for flood in (10 ** 4, 10 ** 5, 10 ** 6):
+        tracemalloc.start()
+        limiter = make_limiter()
+        for i in range(flood):
+            limiter.allow(f"{i >> 24 & 255}.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}", "join")
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{flood:>8} IPs: {len(limiter):>6} buckets, {size / 2 ** 20:>6.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
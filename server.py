@@ -1,30 +1,109 @@
 #!/usr/bin/env python
+import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
 import os
 import logging
+import signal
 
-from beam import Beam
+from beam import Beam, workers, bus, handoff
 
 ENABLE_INSPECT = True
+ENABLE_METRICS = True
 
+# BEAM_LOG_LEVEL=DEBUG logs every traced event, see beam.tracing
 logging.basicConfig(
     format='%(name)s/%(levelname)s: %(message)s',
-    level=logging.DEBUG
+    level=os.environ.get("BEAM_LOG_LEVEL", "INFO").upper()
 )
 
 
-def main():
+# "message=0.01,connect=0.5" keeps 1% of message events and half of connect events
+def trace_sampling(text):
+    rates = {}
+    for item in filter(None, text.split(",")):
+        name, _, rate = item.partition("=")
+        rates[name.strip()] = float(rate)
+    return rates
+
+
+def make_app(shard=0, shards=1, node_bus=None, restore=True):
+    # Every worker keeps its own journal and trace file
+    journal = os.environ.get("BEAM_JOURNAL")
+    if journal and shards > 1:
+        journal = f"{journal}.{shard}"
+    trace_file = os.environ.get("BEAM_TRACE_FILE")
+    if trace_file and shards > 1:
+        trace_file = f"{trace_file}.{shard}"
+
     app = Beam(
         do_inspect=ENABLE_INSPECT,
+        metrics=ENABLE_METRICS,
         max_servers=int(os.environ.get("MAX_SERVERS","3")),
-        max_users=int(os.environ.get("MAX_USERS","3"))
+        max_users=int(os.environ.get("MAX_USERS","3")),
+        max_created=int(os.environ.get("MAX_CREATED", "10")),
+        max_loop_lag=float(os.environ.get("BEAM_MAX_LOOP_LAG", "0.5")),
+        # Has to end before the supervisor's kill timeout (the process
+        # exits a second after it), 30s is a common one
+        drain_timeout=float(os.environ.get("BEAM_DRAIN_TIMEOUT", "20")),
+        shard=shard,
+        shards=shards,
+        bus=node_bus,
+        journal=journal,
+        admin_token=os.environ.get("BEAM_ADMIN_TOKEN"),
+        trace_file=trace_file,
+        trace_sampling=trace_sampling(os.environ.get("BEAM_TRACE_SAMPLING", ""))
     )
+
+    # Bring back the rooms from before the restart
+    if app.journal and restore:
+        app.journal.restore()
+    return app
+
+
+def main():
     port = os.environ.get("PORT")
     if not port:
         port = 8000
-    logging.info("Starting Beam on port {0}".format(port))
-    app.listen(port)
-    tornado.ioloop.IOLoop.current().start()
+    worker_count = int(os.environ.get("BEAM_WORKERS", "1"))
+
+    if worker_count > 1:
+        logging.info("Starting Beam on port {0} with {1} workers".format(port, worker_count))
+        workers.run(make_app, int(port), worker_count)
+    else:
+        # Share rooms with other Beam nodes through a broker
+        # started with `python -m beam.bus <socket path>`
+        node_bus = None
+        if os.environ.get("BEAM_BUS"):
+            node_bus = bus.UnixBus(os.environ["BEAM_BUS"])
+            tornado.ioloop.IOLoop.current().run_sync(node_bus.connect)
+
+        ioloop = tornado.ioloop.IOLoop.current()
+        # Deploys start the new process with the same BEAM_HANDOFF path,
+        # it binds the port next to the old one and takes its rooms over.
+        # The journal is only read when there's no process to take them from.
+        handoff_path = os.environ.get("BEAM_HANDOFF")
+        app = make_app(node_bus=node_bus, restore=not handoff_path)
+        sockets = tornado.netutil.bind_sockets(int(port), reuse_port=bool(handoff_path))
+        if handoff_path:
+            if not ioloop.run_sync(lambda: handoff.take_over(app, handoff_path)) and app.journal:
+                app.journal.restore()
+
+        logging.info("Starting Beam on port {0}".format(port))
+        http_server = tornado.httpserver.HTTPServer(app)
+        http_server.add_sockets(sockets)
+
+        if handoff_path:
+            ioloop.run_sync(handoff.HandoffServer(app, handoff_path, http_server.stop).start)
+
+        # Once everyone is told to reconnect, leave them a moment and exit
+        def migrated():
+            http_server.stop()
+            ioloop.call_later(1, ioloop.stop)
+
+        app.migrated = migrated
+        ioloop.asyncio_loop.add_signal_handler(signal.SIGTERM, app.drain)
+        ioloop.start()
 
 
 if __name__ == "__main__":